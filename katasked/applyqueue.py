@@ -0,0 +1,83 @@
+import collections
+
+import katasked.task.priority as priority
+
+class ApplyQueue(object):
+    """Finished work waiting to be applied to the scene on the main thread. Each
+    item is a tuple whose second element is the task it came from. Items of a
+    model are taken in the order they were added, since its refinements build
+    on each other, but models are taken in order of priority. The priority of
+    a model is only recomputed when its next item changes, or for every model
+    once the camera has moved further than the metrics cache allows."""
+    
+    def __init__(self, supersedes=None):
+        """supersedes is called with a new item and an older item of the same
+        model, and returns True if the older item is made obsolete by the new
+        one and shouldn't be applied"""
+        self.by_slug = collections.OrderedDict()
+        self.num_items = 0
+        self.supersedes = supersedes
+        self.priorities = {}
+        """Priority of applying the next item of each slug, by slug"""
+        self.unscored = set()
+        """Slugs whose next item changed since their priority was computed"""
+        self.scored_poses = None
+        """Camera poses the priorities were all last computed at"""
+    
+    def __len__(self):
+        return self.num_items
+    
+    def append(self, item):
+        """Adds an item, returning the waiting items it superseded"""
+        modelslug = item[1].modelslug
+        if modelslug not in self.by_slug:
+            self.by_slug[modelslug] = collections.deque()
+        items = self.by_slug[modelslug]
+        
+        superseded = []
+        if self.supersedes is not None:
+            superseded = [older for older in items if self.supersedes(item, older)]
+            for older in superseded:
+                items.remove(older)
+            self.num_items -= len(superseded)
+        
+        if len(items) == 0 or len(superseded) > 0:
+            self.unscored.add(modelslug)
+        items.append(item)
+        self.num_items += 1
+        return superseded
+    
+    def ranked_slugs(self, pandastate):
+        """Returns the slugs with items waiting, from the highest priority of
+        their next item to the lowest"""
+        poses = priority.get_camera_poses(pandastate)
+        if self.scored_poses is None or priority.poses_moved(self.scored_poses, poses):
+            slugs = self.by_slug.keys()
+            self.scored_poses = poses
+        else:
+            slugs = list(self.unscored)
+        self.unscored.clear()
+        
+        if len(slugs) > 0:
+            heads = dict((self.by_slug[modelslug][0][1], modelslug) for modelslug in slugs)
+            task_priorities = priority.calc_apply_priority(pandastate, heads.keys(), poses)
+            for task, modelslug in heads.iteritems():
+                self.priorities[modelslug] = task_priorities.get(task, 0.0)
+        
+        return sorted(self.priorities, key=self.priorities.get, reverse=True)
+    
+    def has_items(self, modelslug):
+        return modelslug in self.by_slug
+    
+    def pop(self, modelslug):
+        """Removes and returns the next item of a model"""
+        items = self.by_slug[modelslug]
+        item = items.popleft()
+        if len(items) == 0:
+            del self.by_slug[modelslug]
+            self.priorities.pop(modelslug, None)
+            self.unscored.discard(modelslug)
+        else:
+            self.unscored.add(modelslug)
+        self.num_items -= 1
+        return item
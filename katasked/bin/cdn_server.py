@@ -0,0 +1,45 @@
+#!/usr/bin/env python2
+
+import os
+
+import argparse
+
+import pathmangle
+import katasked.cdn as cdn
+
+def main():
+    parser = argparse.ArgumentParser(description=('Serves a corpus recorded with loadscene.py --record-corpus in place '
+                                                  'of the CDN, for loadscene.py --cdn-domain host:port'))
+    parser.add_argument('--corpus', metavar='directory', required=True,
+                        help='Corpus directory to serve responses from')
+    parser.add_argument('--host', default='localhost', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--latency', metavar='ms', type=float, default=0.0,
+                        help='Milliseconds each response waits before its first byte')
+    parser.add_argument('--bandwidth', metavar='KB/s', type=float,
+                        help='Bandwidth shared by all responses. Unlimited if not given.')
+    parser.add_argument('--loss', metavar='fraction', type=float, default=0.0,
+                        help='Fraction of requests that are dropped without a response')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for dropped requests')
+    parser.add_argument('--verbose', '-v', action='store_true', default=False, help='Log every request')
+    
+    args = parser.parse_args()
+    
+    corpus_dir = os.path.abspath(args.corpus)
+    if not os.path.isdir(corpus_dir):
+        parser.error('Invalid corpus directory: %s' % corpus_dir)
+    
+    link = cdn.Link(latency=args.latency / 1000.0,
+                    bandwidth=None if args.bandwidth is None else args.bandwidth * 1024,
+                    loss=args.loss,
+                    seed=args.seed)
+    server = cdn.CDNServer((args.host, args.port), cdn.Corpus(corpus_dir), link, verbose=args.verbose)
+    
+    print 'Serving %s at %s:%d' % (corpus_dir, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python2
+
+import os
+import time
+import random
+import shutil
+import tempfile
+import threading
+
+import argparse
+
+import pathmangle
+import katasked.cdn as cdn
+import katasked.open3dhub as open3dhub
+import katasked.task.base as taskbase
+import katasked.task.pool as pool
+
+class BenchDownloadTask(taskbase.DownloadTask):
+    """Downloads one file of the bench corpus, bypassing the cache"""
+    
+    def __init__(self, dlhash, size):
+        super(BenchDownloadTask, self).__init__(dlhash)
+        self.download_size = size
+    
+    def run(self):
+        return self.pool.apply_async(open3dhub.urlfetch, [open3dhub.DOWNLOAD_URL + '/' + self.modelslug])
+    
+    def finished(self, result):
+        assert len(result) == self.download_size
+    
+    def __str__(self):
+        return '<BenchDownloadTask %s>' % self.modelslug
+    def __repr__(self):
+        return str(self)
+
+class Unranked(object):
+    """Stands in for a BackgroundScheduler that never has a ranking, so pools
+    take their tasks in queue order without a scene to prioritize them by"""
+    
+    def get_ranking(self, name):
+        return None
+
+class BenchTaskPool(pool.TaskPool):
+    """A TaskPool that doesn't log each task it runs"""
+    
+    LOG_TASKS = False
+
+def file_sizes(args):
+    """Returns the size in bytes of each file. With --mixed, most files are
+    small enough to be bound by latency and the rest by bandwidth."""
+    if not args.mixed:
+        return [args.size * 1024] * args.files
+    
+    rand = random.Random(0)
+    return [5 * 1024 if rand.random() < 0.8 else rand.randint(200 * 1024, 2048 * 1024) for i in range(args.files)]
+
+def make_corpus(corpus_dir, sizes):
+    """Records a download of each size, returning a dict mapping their hashes
+    to their sizes"""
+    corpus = cdn.Corpus(corpus_dir)
+    files = dict(('bench%05d' % i, size) for i, size in enumerate(sizes))
+    for dlhash, size in files.iteritems():
+        corpus.record(cdn.DOWNLOAD_PREFIX + dlhash, None, os.urandom(size))
+    return files
+
+def run_downloads(args, corpus_dir, files, adaptive):
+    """Downloads every file through a fresh server and link, returning
+    (seconds, [(seconds since start, concurrency limit)])"""
+    link = cdn.Link(latency=args.latency / 1000.0, bandwidth=args.bandwidth * 1024)
+    server = cdn.CDNServer(('localhost', 0), cdn.Corpus(corpus_dir), link)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    open3dhub.set_cdn_domain('localhost:%d' % server.server_address[1])
+    
+    controller = None
+    if adaptive:
+        controller = pool.ConcurrencyController(args.procs, 1, args.max_procs)
+    taskpool = BenchTaskPool(args.procs, type_name='bench', scheduler=Unranked(), threaded=True,
+                             controller=controller)
+    for dlhash, size in files.iteritems():
+        taskpool.add_task(BenchDownloadTask(dlhash, size))
+    
+    t0 = time.time()
+    limits = []
+    while not taskpool.empty():
+        taskpool.poll(None)
+        now = time.time() - t0
+        if len(limits) == 0 or now - limits[-1][0] >= 1.0:
+            limits.append((now, taskpool.num_procs))
+        time.sleep(0.005)
+    seconds = time.time() - t0
+    
+    server.shutdown()
+    taskpool.pool.terminate()
+    return seconds, limits
+
+def main():
+    parser = argparse.ArgumentParser(description=('Downloads a synthetic corpus from a local cdn_server.py over a '
+                                                  'throttled link, with a fixed number of downloads at once and with '
+                                                  'adaptive concurrency, and reports how much of the link each used'))
+    parser.add_argument('--latency', metavar='ms', type=float, default=200.0,
+                        help='Milliseconds each response waits before its first byte')
+    parser.add_argument('--bandwidth', metavar='KB/s', type=float, default=4096.0,
+                        help='Bandwidth of the link')
+    parser.add_argument('--files', metavar='N', type=int, default=400, help='Number of files to download')
+    parser.add_argument('--size', metavar='KB', type=int, default=64, help='Size of each file')
+    parser.add_argument('--mixed', action='store_true', default=False,
+                        help='Make 80%% of the files 5 KB and the rest between 200 KB and 2 MB, instead of --size')
+    parser.add_argument('--procs', metavar='N', type=int, default=4,
+                        help='Downloads at once with fixed concurrency, and where adaptive concurrency starts')
+    parser.add_argument('--max-procs', metavar='N', type=int, default=pool.MultiplexPool.MAX_PROCS[taskbase.DownloadTask],
+                        help='Most downloads at once with adaptive concurrency')
+    
+    args = parser.parse_args()
+    
+    corpus_dir = tempfile.mkdtemp(prefix='concurrency_bench')
+    try:
+        files = make_corpus(corpus_dir, file_sizes(args))
+        total_kb = sum(files.itervalues()) / 1024.0
+        
+        print '%-10s %10s %10s %10s %10s' % ('mode', 'downloads', 'seconds', 'KB/s', 'of link')
+        for adaptive in (False, True):
+            seconds, limits = run_downloads(args, corpus_dir, files, adaptive)
+            procs = [limit for t, limit in limits]
+            print '%-10s %10s %10.2f %10.1f %9.1f%%' % ('adaptive' if adaptive else 'fixed',
+                                                        '%d-%d' % (min(procs), max(procs)) if adaptive else args.procs,
+                                                        seconds, total_kb / seconds,
+                                                        100.0 * total_kb / seconds / args.bandwidth)
+        
+        print
+        print 'Adaptive downloads at once over time:'
+        print ' '.join('%.0fs:%d' % (t, limit) for t, limit in limits)
+    finally:
+        shutil.rmtree(corpus_dir)
+
+if __name__ == '__main__':
+    main()
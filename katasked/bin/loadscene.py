@@ -1,6 +1,7 @@
 #!/usr/bin/env python2
 
 import os
+import atexit
 
 import argparse
 
@@ -9,6 +10,7 @@ import katasked.loader as loader
 import katasked.cache as cache
 import katasked.task.priority as priority
 import katasked.open3dhub as open3dhub
+import katasked.trace as trace
 
 def main():
     parser = argparse.ArgumentParser(description='Progressively loads a scene')
@@ -24,7 +26,54 @@ def main():
                         help='The algorithm used for prioritizing tasks')
     parser.add_argument('--priority-input', metavar='vars.json', type=argparse.FileType('r'),
                         help='Input file for priority algorithm if chosen type is FromFile')
+    parser.add_argument('--prediction-horizons', metavar='seconds', type=float, nargs='+', default=[2.0, 5.0],
+                        help='How far ahead of the current time to predict the camera position for priorities')
+    parser.add_argument('--camera-move-tolerance', metavar='units', type=float, default=0.0,
+                        help='How far the camera can move before cached object priorities are recomputed')
+    parser.add_argument('--camera-turn-tolerance', metavar='degrees', type=float, default=0.0,
+                        help='How far the camera can turn before cached object priorities are recomputed')
+    parser.add_argument('--background-priority', action='store_true', default=False,
+                        help='Compute task priorities on a background thread instead of the render thread')
+    parser.add_argument('--download-budget', metavar='seconds', type=float,
+                        help=('Fill free download slots with the tasks worth the most priority that fit in this '
+                              'many seconds of downloads in flight at the measured throughput'))
+    parser.add_argument('--download-threads', metavar='N', type=int,
+                        help=('Run downloads on N threads instead of 4 worker processes. Texture downloads, '
+                              'which decode images with Panda3D, keep 4 worker processes of their own'))
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help='Download each base mesh and convert it to a BAM in a single job')
+    parser.add_argument('--adaptive-concurrency', action='store_true', default=False,
+                        help=('Adjust how many tasks the download and pipeline pools run at once based on their '
+                              'measured goodput'))
+    parser.add_argument('--prefetch', action='store_true', default=False,
+                        help='Use idle download slots to prefetch the next stages of the highest priority models')
+    parser.add_argument('--prefetch-ahead', metavar='N', type=int, default=1,
+                        help=('With --prefetch, prefetch up to N stages ahead of the tasks that need them, fetching '
+                              'consecutive ranges of the same file with one request'))
+    parser.add_argument('--metadata-batch', metavar='N', type=int,
+                        help='Download the metadata of N models at once in each task instead of one at a time')
+    parser.add_argument('--metadata-manifest', metavar='manifest.json', type=argparse.FileType('r'),
+                        help='Scene manifest written by metadata_manifest.py to read model metadata from')
+    parser.add_argument('--apply-budget', metavar='ms', type=float, default=5.0,
+                        help='Milliseconds per frame spent applying finished models, textures and refinements')
+    parser.add_argument('--defer-hidden', action='store_true', default=False,
+                        help=('Hold back texture and refinement downloads of models that are out of view now and at '
+                              'every predicted camera position'))
+    parser.add_argument('--max-apply-mb', metavar='MB', type=float,
+                        help=('Stop starting tasks whose results wait to be applied while this much is waiting. '
+                              'Unlimited if not given.'))
+    parser.add_argument('--max-pending-refinement-mb', metavar='MB', type=float,
+                        help=('Stop downloading mesh refinements while this much waits for base meshes to load. '
+                              'Unlimited if not given.'))
+    parser.add_argument('--trace', metavar='trace.json',
+                        help=('Record what the scheduler does with each task and write it on exit as Chrome trace '
+                              'JSON, for chrome://tracing or Perfetto'))
+    parser.add_argument('--trace-capacity', metavar='N', type=int, default=trace.DEFAULT_CAPACITY,
+                        help='Most recent trace events to keep')
     parser.add_argument('--cdn-domain', metavar='example.com')
+    parser.add_argument('--record-corpus', metavar='directory',
+                        help=('Save every CDN response into a corpus directory that cdn_server.py can serve. Start '
+                              'from an empty --cache-dir so that nothing is left out.'))
     
     args = parser.parse_args()
     
@@ -46,6 +95,12 @@ def main():
     
     cache.init_cache(cachedir)
     
+    if args.trace is not None:
+        trace.init_trace(args.trace_capacity)
+        atexit.register(trace.write_trace, os.path.abspath(args.trace))
+    
+    priority.set_prediction_horizons(args.prediction_horizons)
+    
     if args.priority_algorithm is not None:
         algorithm = priority.get_algorithm_by_name(args.priority_algorithm)
         
@@ -55,15 +110,42 @@ def main():
                 parser.error("An input file must be specified for FromFile priority algorithm")
             algo_inputs = [args.priority_input]
         
-        priority.set_priority_algorithm(algorithm(*algo_inputs))
+        try:
+            priority.set_priority_algorithm(algorithm(*algo_inputs))
+        except ValueError, e:
+            parser.error(str(e))
+    
+    priority.set_camera_tolerance(args.camera_move_tolerance, args.camera_turn_tolerance)
     
     if args.cdn_domain is not None:
         open3dhub.set_cdn_domain(args.cdn_domain)
+    if args.record_corpus is not None:
+        open3dhub.set_record_corpus(os.path.abspath(args.record_corpus))
+    
+    max_apply_bytes = None
+    if args.max_apply_mb is not None:
+        max_apply_bytes = int(args.max_apply_mb * 1024 * 1024)
+    max_pm_waiting_bytes = None
+    if args.max_pending_refinement_mb is not None:
+        max_pm_waiting_bytes = int(args.max_pending_refinement_mb * 1024 * 1024)
     
     app = loader.ProgressiveLoader(args.scene,
                                    capturefile=args.capture,
                                    showstats=args.show_stats,
-                                   screenshot_dir=outdir)
+                                   screenshot_dir=outdir,
+                                   background_priority=args.background_priority,
+                                   download_budget=args.download_budget,
+                                   download_threads=args.download_threads,
+                                   pipeline=args.pipeline,
+                                   adaptive_concurrency=args.adaptive_concurrency,
+                                   prefetch=args.prefetch,
+                                   prefetch_ahead=args.prefetch_ahead,
+                                   metadata_batch=args.metadata_batch,
+                                   metadata_manifest=args.metadata_manifest,
+                                   apply_budget=args.apply_budget / 1000.0,
+                                   defer_hidden=args.defer_hidden,
+                                   max_apply_bytes=max_apply_bytes,
+                                   max_pm_waiting_bytes=max_pm_waiting_bytes)
     app.run()
 
 if __name__ == '__main__':
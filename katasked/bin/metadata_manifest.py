@@ -0,0 +1,39 @@
+#!/usr/bin/env python2
+
+import os
+import json
+
+import argparse
+
+import pathmangle
+import katasked.scene as scene
+import katasked.open3dhub as open3dhub
+
+def main():
+    parser = argparse.ArgumentParser(description=('Downloads the metadata of every unique model in a scene into a '
+                                                  'manifest that loadscene.py can read instead of fetching it'))
+    parser.add_argument('--scene', '-s', metavar='scene.json', type=argparse.FileType('r'), required=True,
+                        help='Scene file to download metadata for.')
+    parser.add_argument('--output', '-o', metavar='manifest.json', type=argparse.FileType('w'), required=True,
+                        help='File to write the manifest to.')
+    parser.add_argument('--threads', metavar='N', type=int, default=16,
+                        help='Number of metadata requests to make at once')
+    parser.add_argument('--cdn-domain', metavar='example.com')
+    parser.add_argument('--record-corpus', metavar='directory',
+                        help='Also save the metadata responses into a corpus directory that cdn_server.py can serve')
+    
+    args = parser.parse_args()
+    
+    if args.cdn_domain is not None:
+        open3dhub.set_cdn_domain(args.cdn_domain)
+    if args.record_corpus is not None:
+        open3dhub.set_record_corpus(os.path.abspath(args.record_corpus))
+    
+    paths = sorted(set(m.path for m in scene.Scene.fromfile(args.scene)))
+    metadatas = open3dhub.get_metadata_many(paths, num_threads=args.threads)
+    json.dump(dict(zip(paths, metadatas)), args.output)
+    
+    print 'Wrote metadata of %d models' % len(paths)
+
+if __name__ == '__main__':
+    main()
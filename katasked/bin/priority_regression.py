@@ -0,0 +1,116 @@
+#!/usr/bin/env python2
+
+import sys
+import time
+import math
+import random
+
+import argparse
+import numpy
+import panda3d.core as p3d
+
+import pathmangle
+import katasked.scene as scene
+import katasked.panda
+import katasked.task.priority as priority
+
+def nodepath_camera_angle(camera_np, camera_forward, obj_bounds):
+    """Reference camera angle metric, computed one object at a time by pointing
+    a NodePath at the closest point of the bounding sphere"""
+    inside = obj_bounds.contains(camera_np.getPos())
+    if inside & p3d.BoundingVolume.IFAll:
+        return 1.0
+    
+    to_center = camera_np.getPos() - obj_bounds.getCenter()
+    to_center.normalize()
+    closest_point = obj_bounds.getCenter() + to_center * obj_bounds.getRadius()
+    
+    camera_np.lookAt(closest_point)
+    copied_forward = camera_np.getQuat().getForward()
+    copied_forward.normalize()
+    angle_change = copied_forward.angleDeg(camera_forward)
+    return 1.0 - (angle_change / 180.0)
+
+def nodepath_solid_angle(camera_pos, np):
+    """Reference solid angle metric, computed one object at a time from its NodePath"""
+    to_center = camera_pos - np.getPos()
+    to_center_len = to_center.length()
+    np_radius = np.getScale()[0]
+    
+    if to_center_len <= np_radius:
+        return 1.0
+    
+    sin_alpha = np_radius / to_center_len
+    cos_alpha = math.sqrt(1.0 - sin_alpha * sin_alpha)
+    return 2.0 * math.pi * (1.0 - cos_alpha) / priority.MAX_SOLID_ANGLE
+
+def main():
+    parser = argparse.ArgumentParser(description=('Checks the batched priority metrics against the original per-object '
+                                                  'NodePath implementation for random camera poses in a scene'))
+    parser.add_argument('--scene', '-s', metavar='scene.json', type=argparse.FileType('r'), required=True,
+                        help='Scene file to place objects from.')
+    parser.add_argument('--poses', type=int, default=50, help='Number of random camera poses to check')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='Largest allowed difference in a metric')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for camera poses')
+    
+    args = parser.parse_args()
+    random.seed(args.seed)
+    
+    scenemodels = scene.Scene.fromfile(args.scene)
+    
+    nodepaths = {}
+    obj_bounds = {}
+    for model in scenemodels:
+        np = p3d.NodePath(model.slug)
+        np.setPos(model.x, model.y, model.z)
+        np.setScale(model.scale, model.scale, model.scale)
+        nodepaths[model] = np
+        obj_bounds[np] = p3d.BoundingSphere(np.getPos(), np.getScale()[0])
+    
+    bounds = katasked.panda.InstanceBounds(nodepaths, obj_bounds)
+    minpt = bounds.centers.min(axis=0)
+    maxpt = bounds.centers.max(axis=0)
+    
+    camera_np = p3d.NodePath("camera")
+    lookat_np = p3d.NodePath("tempnode")
+    max_diff = {'camera_angle': 0.0, 'solid_angle': 0.0}
+    reference_time = 0.0
+    batched_time = 0.0
+    
+    for i in range(args.poses):
+        camera_np.setPos(*[random.uniform(lo, hi) for lo, hi in zip(minpt, maxpt)])
+        camera_np.setHpr(random.uniform(-180, 180), random.uniform(-90, 90), random.uniform(-180, 180))
+        camera_pos = camera_np.getPos()
+        camera_forward = camera_np.getQuat().getForward()
+        camera_forward.normalize()
+        
+        t0 = time.time()
+        lookat_np.setPosQuat(camera_pos, camera_np.getQuat())
+        reference_camera_angle = numpy.array([nodepath_camera_angle(lookat_np, camera_forward, obj_bounds[np])
+                                              for np in bounds.nodepaths])
+        reference_solid_angle = numpy.array([nodepath_solid_angle(camera_pos, np) for np in bounds.nodepaths])
+        t1 = time.time()
+        camera_angle = priority.calc_camera_angle(priority.to_array(camera_pos), priority.to_array(camera_forward),
+                                                  bounds.centers, bounds.radii)
+        solid_angle = priority.calc_solid_angle(priority.to_array(camera_pos), bounds.centers, bounds.radii)
+        t2 = time.time()
+        
+        reference_time += t1 - t0
+        batched_time += t2 - t1
+        max_diff['camera_angle'] = max(max_diff['camera_angle'], numpy.abs(camera_angle - reference_camera_angle).max())
+        max_diff['solid_angle'] = max(max_diff['solid_angle'], numpy.abs(solid_angle - reference_solid_angle).max())
+    
+    print '%d objects, %d camera poses' % (len(bounds), args.poses)
+    print 'per-object time: %.3f ms, batched time: %.3f ms (%.1fx)' % (reference_time / args.poses * 1000,
+                                                                        batched_time / args.poses * 1000,
+                                                                        reference_time / max(batched_time, 1e-9))
+    failed = False
+    for name, diff in sorted(max_diff.iteritems()):
+        ok = diff <= args.tolerance
+        failed = failed or not ok
+        print '%-14s max difference %.3g %s' % (name, diff, 'OK' if ok else 'FAILED')
+    
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python2
+
+import os
+import json
+import time
+import multiprocessing
+
+import argparse
+
+import pathmangle
+import katasked.scene as scene
+import katasked.cache as cache
+import katasked.simulator as simulator
+import katasked.open3dhub as open3dhub
+import katasked.task.metadata as metadata
+import katasked.task.priority as priority
+
+def load_corpus(args, scenemodels):
+    """Returns the metadata of every model in the scene keyed by slug, read
+    from the manifest if one was given and downloaded otherwise"""
+    if args.metadata_manifest is not None:
+        return metadata.load_manifest(args.metadata_manifest)
+    
+    paths = sorted(set(m.path for m in scenemodels))
+    metadatas = open3dhub.get_metadata_many(paths)
+    return dict((path.replace('/', '~'), md) for path, md in zip(paths, metadatas))
+
+def run_algorithm(job):
+    """Simulates the scene with one priority algorithm, returning (algorithm
+    name, mean error, error samples, simulated seconds, wall seconds, seconds
+    to finish loading or None)"""
+    algorithm_name, priority_input, prediction_horizons, scenemodels, capturedata, corpus, latency, options = job
+    
+    priority.set_prediction_horizons(prediction_horizons)
+    algorithm = priority.get_algorithm_by_name(algorithm_name)
+    algo_inputs = []
+    if issubclass(algorithm, priority.FromFile):
+        algo_inputs = [open(priority_input, 'r')]
+    priority.set_priority_algorithm(algorithm(*algo_inputs))
+    
+    t0 = time.time()
+    sim = simulator.Simulator(scenemodels, capturedata, corpus, latency=latency, **options)
+    curve = sim.run()
+    wall_seconds = time.time() - t0
+    
+    return algorithm_name, simulator.mean_error(curve), curve, sim.duration, wall_seconds, sim.finished_loading
+
+def main():
+    parser = argparse.ArgumentParser(description=('Replays a motion capture over a scene against the scheduler in '
+                                                  'simulated time, without rendering or downloading models, and '
+                                                  'scores each priority algorithm by the error of the view'))
+    parser.add_argument('--scene', '-s', metavar='scene.json', type=argparse.FileType('r'), required=True,
+                        help='Scene file to simulate.')
+    parser.add_argument('--capture', '-c', metavar='motioncap.json', type=argparse.FileType('r'), required=True,
+                        help='File of the motion capture to use for the camera.')
+    parser.add_argument('--metadata-manifest', metavar='manifest.json', type=argparse.FileType('r'),
+                        help=('Scene manifest written by metadata_manifest.py to read model metadata from. If not '
+                              'given, the metadata is downloaded first.'))
+    parser.add_argument('--cache-dir', metavar='directory', help='Directory to use for cache files')
+    parser.add_argument('--cdn-domain', metavar='example.com')
+    parser.add_argument('--priority-algorithm', choices=priority.get_priority_algorithm_names(), nargs='+',
+                        default=['HandTuned1'], help='The algorithms to simulate')
+    parser.add_argument('--priority-input', metavar='vars.json',
+                        help='Input file for priority algorithm if chosen type is FromFile')
+    parser.add_argument('--prediction-horizons', metavar='seconds', type=float, nargs='+', default=[2.0, 5.0],
+                        help='How far ahead of the current time to predict the camera position for priorities')
+    parser.add_argument('--latency-trace', metavar='trace.json', type=argparse.FileType('r'),
+                        help='Trace written by loadscene.py --trace to fit the time each type of task takes to')
+    parser.add_argument('--rtt', metavar='seconds', type=float, default=0.1,
+                        help='Round trip time of a download when there is no trace for its task type')
+    parser.add_argument('--bandwidth', metavar='KB/s', type=float, default=1024.0,
+                        help='Bandwidth shared by the downloads of a pool when there is no trace for their task type')
+    parser.add_argument('--sample-interval', metavar='seconds', type=float, default=0.5,
+                        help='Simulated seconds between samples of the error of the view')
+    parser.add_argument('--download-budget', metavar='seconds', type=float,
+                        help='Fill a byte budget of this many seconds of downloads, as in loadscene.py')
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help='Download each base mesh and convert it to a BAM in a single job')
+    parser.add_argument('--adaptive-concurrency', action='store_true', default=False,
+                        help=('Adjust how many tasks the download and pipeline pools run at once based on their '
+                              'measured goodput'))
+    parser.add_argument('--prefetch', action='store_true', default=False,
+                        help='Use idle download slots to prefetch the next stages of the highest priority models')
+    parser.add_argument('--prefetch-ahead', metavar='N', type=int, default=1,
+                        help=('With --prefetch, prefetch up to N stages ahead of the tasks that need them, fetching '
+                              'consecutive ranges of the same file with one request'))
+    parser.add_argument('--defer-hidden', action='store_true', default=False,
+                        help='Hold back texture and refinement downloads of models that are out of view')
+    parser.add_argument('--metadata-batch', metavar='N', type=int,
+                        help='Download the metadata of N models at once in each task instead of one at a time')
+    parser.add_argument('--processes', metavar='N', type=int, default=1,
+                        help='Number of algorithms to simulate at once')
+    parser.add_argument('--output', '-o', metavar='results.json', type=argparse.FileType('w'),
+                        help='File to write the score and error samples of each algorithm to')
+    
+    args = parser.parse_args()
+    
+    priority.set_prediction_horizons(args.prediction_horizons)
+    for algorithm_name in args.priority_algorithm:
+        algorithm = priority.get_algorithm_by_name(algorithm_name)
+        algo_inputs = []
+        if issubclass(algorithm, priority.FromFile):
+            if args.priority_input is None:
+                parser.error("An input file must be specified for FromFile priority algorithm")
+            algo_inputs = [open(args.priority_input, 'r')]
+        try:
+            priority.set_priority_algorithm(algorithm(*algo_inputs))
+        except ValueError, e:
+            parser.error(str(e))
+    
+    cachedir = None
+    if args.cache_dir is not None:
+        cachedir = os.path.abspath(args.cache_dir)
+        if os.path.exists(cachedir) and not os.path.isdir(cachedir):
+            parser.error('Invalid cache directory: %s' % cachedir)
+        elif not os.path.exists(cachedir):
+            os.mkdir(cachedir)
+    cache.init_cache(cachedir)
+    
+    if args.cdn_domain is not None:
+        open3dhub.set_cdn_domain(args.cdn_domain)
+    
+    scenemodels = list(scene.Scene.fromfile(args.scene))
+    capturedata = json.load(args.capture)
+    corpus = load_corpus(args, scenemodels)
+    
+    if args.latency_trace is not None:
+        latency = simulator.TraceLatencyModel(args.latency_trace, rtt=args.rtt, bandwidth=args.bandwidth * 1024)
+    else:
+        latency = simulator.LatencyModel(rtt=args.rtt, bandwidth=args.bandwidth * 1024)
+    
+    options = {'sample_interval': args.sample_interval,
+               'metadata_batch': args.metadata_batch,
+               'download_budget': args.download_budget,
+               'pipeline': args.pipeline,
+               'adaptive_concurrency': args.adaptive_concurrency,
+               'prefetch': args.prefetch,
+               'prefetch_ahead': args.prefetch_ahead,
+               'defer_hidden': args.defer_hidden}
+    
+    # the priority algorithm is global, so each one is simulated in a process of its own
+    jobs = [(name, args.priority_input, args.prediction_horizons, scenemodels, capturedata, corpus, latency, options)
+            for name in args.priority_algorithm]
+    workers = multiprocessing.Pool(args.processes, maxtasksperchild=1)
+    results = workers.map(run_algorithm, jobs, chunksize=1)
+    workers.close()
+    workers.join()
+    
+    print '%-20s %10s %10s %10s %10s %10s' % ('algorithm', 'score', 'sim secs', 'loaded at', 'wall secs', 'speedup')
+    for algorithm_name, score, curve, sim_seconds, wall_seconds, loaded_seconds in results:
+        print '%-20s %10.5f %10.1f %10s %10.2f %9.1fx' % (algorithm_name, score, sim_seconds,
+                                                          '-' if loaded_seconds is None else '%.1f' % loaded_seconds,
+                                                          wall_seconds, sim_seconds / max(wall_seconds, 1e-9))
+    
+    if args.output is not None:
+        json.dump(dict((algorithm_name, {'score': score, 'samples': curve, 'finished_loading': loaded_seconds})
+                       for algorithm_name, score, curve, sim_seconds, wall_seconds, loaded_seconds in results),
+                  args.output)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import os
+import threading
 import shove
 import open3dhub
 import util
@@ -22,6 +23,9 @@ class Cache(object):
         self.bamdata_cache_file = os.path.join(self.cache_dir, '.bam-cache')
         if not os.path.isdir(self.bamdata_cache_file):
             os.mkdir(self.bamdata_cache_file)
+        
+        # shove stores aren't thread safe either, so accesses are serialized
+        self.lock = threading.Lock()
 
     # Sometimes this exception gets thrown:
     #   RuntimeError: dictionary changed size during iteration
@@ -31,19 +35,21 @@ class Cache(object):
     # times in a row is low enough that it's safe(ish).
     @util.retry(RuntimeError, 4, 1, 2)
     def _cache_wrap(self, shover, key, func, *args, **kwargs):
-        def _getkey():
-            if key not in shover:
-                shover[key] = func(*args, **kwargs)
-            return shover[key]
-        
         # If the program crashes while writing a cache key to disk, it can result
         # in invalid data that can't be unpickled. It manifests as an EOFError in
-        # the unpickler, so if this happens, just delete the key and try again.
-        try:
-            return _getkey()
-        except EOFError:
-            del shover[key]
-            return _getkey()
+        # the unpickler, so if this happens, just delete the key and fetch it again.
+        with self.lock:
+            try:
+                if key in shover:
+                    return shover[key]
+            except EOFError:
+                del shover[key]
+        
+        # the lock isn't held while fetching, so threads can fetch in parallel
+        value = func(*args, **kwargs)
+        with self.lock:
+            shover[key] = value
+        return value
     
     def cache_metadata_wrap(self, key, func, *args, **kwargs):
         return self._cache_wrap(self.metadata_shover, key, func, *args, **kwargs)
@@ -0,0 +1,259 @@
+import os
+import re
+import time
+import random
+import urllib
+import urlparse
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+
+DOWNLOAD_PREFIX = '/download/'
+
+FULL_FILE = 'full'
+"""Name of a whole download in the directory of its hash"""
+
+SEND_CHUNK_SIZE = 16 * 1024
+
+_RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def requested_range(query, range_header):
+    """Returns the (first, last) bytes asked for by a download, from its start
+    and end query parameters or else its Range header, or None for the whole
+    file. Either can be None for the suffix and open ended forms of the Range
+    header. Ranges the header doesn't allow, such as a list of ranges, are
+    ignored as HTTP allows."""
+    params = urlparse.parse_qs(query)
+    if 'start' in params and 'end' in params:
+        return int(params['start'][0]), int(params['end'][0])
+    
+    if range_header is None:
+        return None
+    match = _RANGE_HEADER.match(range_header.strip())
+    if match is None or match.group(1) == match.group(2) == '':
+        return None
+    first, last = [int(g) if g != '' else None for g in match.groups()]
+    if first is not None and last is not None and last < first:
+        return None
+    return first, last
+
+def resolve_range(first, last, size):
+    """Returns the [start, end) of a (first, last) range in a file of size
+    bytes, or None if size is None and the range needs it"""
+    if first is None:
+        if size is None:
+            return None
+        return max(size - last, 0), size
+    if last is None or (size is not None and last >= size):
+        if size is None:
+            return None
+        last = size - 1
+    return first, last + 1
+
+def _write_atomic(path, data):
+    # several worker processes may record the same response at once
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(temp_path, path)
+
+class Corpus(object):
+    """A directory of recorded CDN responses. Downloads are kept under
+    download/<hash>/, as the whole file or as pieces named <start>-<end>, and
+    any range covered by what was recorded can be read back. Every other
+    response is kept under responses/ by its quoted path and query."""
+    
+    def __init__(self, corpus_dir):
+        self.corpus_dir = corpus_dir
+        self.pieces = {}
+    
+    def _hash_dir(self, dlhash):
+        return os.path.join(self.corpus_dir, 'download', dlhash)
+    
+    def _response_path(self, path, query):
+        key = path + ('?' + query if query else '')
+        return os.path.join(self.corpus_dir, 'responses', urllib.quote(key, safe=''))
+    
+    def record(self, url, range_header, data):
+        """Saves the response data of a request for url"""
+        parsed = urlparse.urlparse(url)
+        if not parsed.path.startswith(DOWNLOAD_PREFIX):
+            _write_atomic(self._response_path(parsed.path, parsed.query), data)
+            return
+        
+        dlhash = parsed.path[len(DOWNLOAD_PREFIX):]
+        byte_range = requested_range(parsed.query, range_header)
+        if byte_range is None:
+            _write_atomic(os.path.join(self._hash_dir(dlhash), FULL_FILE), data)
+            return
+        
+        start = byte_range[0]
+        if start is None:
+            # a suffix of a file of unknown size can't be placed
+            return
+        _write_atomic(os.path.join(self._hash_dir(dlhash), '%d-%d' % (start, start + len(data))), data)
+    
+    def response(self, path, query):
+        """Returns a recorded response that isn't a download, or None"""
+        response_path = self._response_path(path, query)
+        if not os.path.isfile(response_path):
+            return None
+        with open(response_path, 'rb') as f:
+            return f.read()
+    
+    def size(self, dlhash):
+        """Returns the size of a download if the whole file was recorded, else None"""
+        full_path = os.path.join(self._hash_dir(dlhash), FULL_FILE)
+        return os.path.getsize(full_path) if os.path.isfile(full_path) else None
+    
+    def _list_pieces(self, dlhash):
+        # the corpus doesn't change while it's served, so listings are kept
+        if dlhash not in self.pieces:
+            pieces = []
+            hash_dir = self._hash_dir(dlhash)
+            if os.path.isdir(hash_dir):
+                for name in os.listdir(hash_dir):
+                    match = re.match(r'^(\d+)-(\d+)$', name)
+                    if match is not None:
+                        pieces.append((int(match.group(1)), int(match.group(2)), name))
+            self.pieces[dlhash] = sorted(pieces)
+        return self.pieces[dlhash]
+    
+    def read(self, dlhash, start=None, end=None):
+        """Returns bytes [start, end) of a download, or the whole file if start
+        is None, or None if the corpus doesn't cover them"""
+        full_path = os.path.join(self._hash_dir(dlhash), FULL_FILE)
+        if os.path.isfile(full_path):
+            with open(full_path, 'rb') as f:
+                if start is None:
+                    return f.read()
+                f.seek(start)
+                return f.read(end - start)
+        if start is None:
+            return None
+        
+        # stitch the range together from the recorded pieces
+        parts = []
+        offset = start
+        for piece_start, piece_end, name in self._list_pieces(dlhash):
+            if offset >= end:
+                break
+            if piece_start > offset or piece_end <= offset:
+                continue
+            with open(os.path.join(self._hash_dir(dlhash), name), 'rb') as f:
+                f.seek(offset - piece_start)
+                parts.append(f.read(min(end, piece_end) - offset))
+            offset = min(end, piece_end)
+        
+        if offset < end:
+            return None
+        return ''.join(parts)
+
+class Link(object):
+    """A network link shared by every connection to the server. Each response
+    waits latency seconds before its first byte, and bytes are sent no faster
+    than bandwidth bytes per second in total. A request is dropped without a
+    response with probability loss."""
+    
+    def __init__(self, latency=0.0, bandwidth=None, loss=0.0, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.next_free = 0.0
+    
+    def dropped(self):
+        with self.lock:
+            return self.random.random() < self.loss
+    
+    def send(self, wfile, data):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        for offset in range(0, len(data), SEND_CHUNK_SIZE):
+            chunk = data[offset:offset + SEND_CHUNK_SIZE]
+            if self.bandwidth is not None:
+                with self.lock:
+                    now = time.time()
+                    sent_at = max(now, self.next_free) + len(chunk) / float(self.bandwidth)
+                    self.next_free = sent_at
+                time.sleep(sent_at - now)
+            wfile.write(chunk)
+
+class CDNRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers CDN requests from the server's corpus"""
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def do_GET(self):
+        corpus, link = self.server.corpus, self.server.link
+        if link.dropped():
+            self.close_connection = True
+            return
+        
+        parsed = urlparse.urlparse(self.path)
+        if not parsed.path.startswith(DOWNLOAD_PREFIX):
+            data = corpus.response(parsed.path, parsed.query)
+            if data is None:
+                return self._send_error(404)
+            return self._send(200, data)
+        
+        dlhash = parsed.path[len(DOWNLOAD_PREFIX):]
+        byte_range = requested_range(parsed.query, self.headers.getheader('Range'))
+        size = corpus.size(dlhash)
+        if byte_range is None:
+            data = corpus.read(dlhash)
+            if data is None:
+                return self._send_error(404)
+            return self._send(200, data)
+        
+        first, last = byte_range
+        if size is not None and (last == 0 if first is None else first >= size):
+            return self._send_error(416, {'Content-Range': 'bytes */%d' % size})
+        resolved = resolve_range(first, last, size)
+        data = None if resolved is None else corpus.read(dlhash, *resolved)
+        if data is None:
+            return self._send_error(404)
+        
+        start, end = resolved
+        content_range = 'bytes %d-%d/%s' % (start, end - 1, '*' if size is None else size)
+        self._send(206, data, {'Content-Range': content_range})
+    
+    def _send(self, code, data, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Accept-Ranges', 'bytes')
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.server.link.send(self.wfile, data)
+    
+    def _send_error(self, code, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+    
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class CDNServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a Corpus over a Link, in place of the CDN open3dhub talks to"""
+    
+    daemon_threads = True
+    
+    def __init__(self, address, corpus, link, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CDNRequestHandler)
+        self.corpus = corpus
+        self.link = link
+        self.verbose = verbose
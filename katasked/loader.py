@@ -20,7 +20,10 @@ import katasked.scene as scene
 import katasked.motioncap as motioncap
 import katasked.panda
 import katasked.task.pool as pool
+import katasked.task.base as taskbase
 import katasked.task.metadata as metadata
+import katasked.trace as trace
+import katasked.applyqueue as applyqueue
 import katasked.task.mesh as meshtask
 import katasked.task.texture as texturetask
 import katasked.task.refinement as refinementtask
@@ -31,15 +34,42 @@ class LOAD_TYPE:
     TEXTURE_UPDATE = 1
     MESH_REFINEMENT = 2
 
+def _supersedes(item, older):
+    """Texture levels are added in increasing order and each replaces the whole
+    texture, so a new texture update makes the waiting ones of its model
+    obsolete"""
+    return item[0] == LOAD_TYPE.TEXTURE_UPDATE and older[0] == LOAD_TYPE.TEXTURE_UPDATE
+
+def _pending_size(t):
+    """Rough number of bytes the result of a finished task takes up in memory
+    until it's applied"""
+    if isinstance(t, texturetask.TextureDownloadTask):
+        # decoded RGBA
+        return t.levelinfo['width'] * t.levelinfo['height'] * 4
+    elif isinstance(t, refinementtask.MeshRefinementDownloadTask):
+        return t.length
+    return t.progressive['size_gzip']
+
 class ProgressiveLoader(ShowBase.ShowBase):
     
-    def __init__(self, scenefile, capturefile=None, showstats=False, screenshot_dir=None):
+    def __init__(self, scenefile, capturefile=None, showstats=False, screenshot_dir=None, background_priority=False,
+                 download_budget=None, download_threads=None, pipeline=False,
+                 adaptive_concurrency=False, prefetch=False, prefetch_ahead=1, metadata_batch=None,
+                 metadata_manifest=None, apply_budget=0.005, defer_hidden=False, max_apply_bytes=None,
+                 max_pm_waiting_bytes=None):
         
         self.scenefile = scenefile
         self.capturefile = capturefile
         self.scene = scene.Scene.fromfile(scenefile)
         self.unique_models = set(m.slug for m in self.scene)
-        self.multiplexer = pool.MultiplexPool()
+        self.multiplexer = pool.MultiplexPool(background_priority=background_priority,
+                                             download_budget=download_budget,
+                                             download_threads=download_threads,
+                                             pipeline=pipeline,
+                                             adaptive_concurrency=adaptive_concurrency,
+                                             prefetch=prefetch,
+                                             prefetch_ahead=prefetch_ahead,
+                                             defer_hidden=defer_hidden)
         self.screenshot_dir = screenshot_dir
         
         print '%d objects in scene, %d unique' % (len(self.scene), len(self.unique_models))
@@ -108,15 +138,21 @@ class ProgressiveLoader(ShowBase.ShowBase):
         #for rbc in self.rigid_body_combiners.itervalues():
         #    rbc.collect()
         
-        self.waiting = []
+        self.waiting = applyqueue.ApplyQueue(supersedes=_supersedes)
+        self.apply_budget = apply_budget
+        self.texture_offsets = {}
+        """Offset of the highest texture level of each model applied or waiting"""
         self.pm_waiting = collections.defaultdict(list)
+        self.max_apply_bytes = max_apply_bytes
+        self.max_pm_waiting_bytes = max_pm_waiting_bytes
+        self.apply_bytes = 0
+        """Estimated bytes of finished models, textures and refinements being loaded or in waiting"""
+        self.pm_waiting_bytes = 0
+        """Estimated bytes of refinements in pm_waiting"""
+        self.held_types = ()
         self.models_loaded = set()
         self.loading_priority = 2147483647
         
-        for m in self.unique_models:
-            t = metadata.MetadataDownloadTask(m)
-            self.multiplexer.add_task(t)
-        
         self.disableMouse()
         pcore.attachLights(self.render)
         self.render.setShaderAuto()
@@ -150,6 +186,11 @@ class ProgressiveLoader(ShowBase.ShowBase):
             
             self.update_stats()
         
+        manifest = {}
+        if metadata_manifest is not None:
+            manifest = metadata.load_manifest(metadata_manifest)
+        self.queue_metadata(manifest, metadata_batch)
+        
         self.globalClock = p3d.ClockObject.getGlobalClock()
         
         self.smooth_mover = SmoothMover()
@@ -183,8 +224,14 @@ class ProgressiveLoader(ShowBase.ShowBase):
             controls.MouseCamera()
         
         self.update_camera_predictor_task = self.taskMgr.doMethodLater(0.1, self.update_camera_predictor, 'update_camera_predictor')
-        self.update_priority_task = self.taskMgr.doMethodLater(0.5, self.check_pool, 'check_pool')
-        self.load_waiting_task = self.taskMgr.doMethodLater(0.1, self.load_waiting, 'load_waiting')
+        # check_pool runs every frame, but only polls when a task has
+        # finished or its delay has passed
+        self.next_pool_check = time.time() + 0.5
+        self.finished_loading = False
+        """Whether FINISHED LOADING has been printed since there was work to run"""
+        self.update_priority_task = self.taskMgr.add(self.check_pool, 'check_pool')
+        # applies finished work every frame, for up to apply_budget seconds
+        self.load_waiting_task = self.taskMgr.add(self.load_waiting, 'load_waiting')
         
     def run(self):
         if self.screenshot_dir is not None:
@@ -209,119 +256,210 @@ class ProgressiveLoader(ShowBase.ShowBase):
     
     def check_pool(self, task):
         t0 = time.time()
-        finished_tasks = self.multiplexer.poll(self.pandastate)
-        t1 = time.time()
-        time_took = t1-t0
-        time_wait = time_took * 2.0
-        time_wait = min(time_wait, 1)
-        time_wait = max(time_wait, 0.1)
-        task.delayTime = time_wait
-        
-        if len(finished_tasks) == 0 and self.multiplexer.empty():
-            print
-            print 'FINISHED LOADING'
-            print
-            return task.done
+        # finished tasks are handled right away, but the queues are only
+        # reprioritized as often as the back-off allows
+        reprioritize = t0 >= self.next_pool_check
+        if not reprioritize and not self.multiplexer.has_completed():
+            return task.cont
+        
+        held_types = self.held_task_types()
+        if held_types != self.held_types:
+            print 'Holding back', ', '.join(held.__name__ for held in held_types) or 'nothing'
+            self.held_types = held_types
+            self.multiplexer.hold(held_types)
+        
+        finished_tasks = self.multiplexer.poll(self.pandastate, reprioritize)
+        if reprioritize:
+            t1 = time.time()
+            time_took = t1-t0
+            time_wait = time_took * 2.0
+            time_wait = min(time_wait, 1)
+            time_wait = max(time_wait, 0.1)
+            self.next_pool_check = t1 + time_wait
+        
+        # tasks deferred by defer_hidden don't count, but keep the pool
+        # polled so they're queued again if their models come into view
+        if len(finished_tasks) == 0 and self.multiplexer.empty(include_deferred=False):
+            if not self.finished_loading:
+                self.finished_loading = True
+                print
+                print 'FINISHED LOADING'
+                if self.multiplexer.prefetcher is not None:
+                    print self.multiplexer.prefetcher.summary()
+                print
+            if self.multiplexer.empty():
+                return task.done
+        else:
+            self.finished_loading = False
         
         for t in finished_tasks:
-            if isinstance(t, meshtask.MeshLoadTask):
-                self.loader.loadModel(t.bam_file, callback=self.model_loaded, extraArgs=[t.modelslug], priority=self.loading_priority)
+            if isinstance(t, (meshtask.MeshLoadTask, meshtask.MeshPipelineTask)):
+                self.apply_bytes += _pending_size(t)
+                self.loader.loadModel(t.bam_file, callback=self.model_loaded, extraArgs=[t], priority=self.loading_priority)
             elif isinstance(t, texturetask.TextureDownloadTask):
-                self.loader.loadModel(t.bam_file, callback=self.texture_loaded, extraArgs=[t.modelslug], priority=self.loading_priority)
+                self.apply_bytes += _pending_size(t)
+                self.loader.loadModel(t.bam_file, callback=self.texture_loaded, extraArgs=[t], priority=self.loading_priority)
             elif isinstance(t, refinementtask.MeshRefinementDownloadTask):
                 if t.modelslug in self.models_loaded:
-                    self.waiting.append((LOAD_TYPE.MESH_REFINEMENT, t.modelslug, t.pm_refinements))
+                    self.apply_bytes += _pending_size(t)
+                    self.waiting.append((LOAD_TYPE.MESH_REFINEMENT, t, t.modelslug, t.pm_refinements))
                 else:
-                    self.pm_waiting[t.modelslug].append(t.pm_refinements)
+                    self.pm_waiting_bytes += _pending_size(t)
+                    self.pm_waiting[t.modelslug].append(t)
             elif isinstance(t, metadata.MetadataDownloadTask):
-                if self.showstats:
-                    self.num_metadata_loaded += 1
-                    
-                    progressive = t.metadata['metadata']['types']['progressive']
-                    byte_ranges = progressive['mipmaps']['./atlas.jpg']['byte_ranges']
-                    baselevel = len(byte_ranges)
-                    for i, levelinfo in enumerate(byte_ranges):
-                        if levelinfo['width'] >= 128 or levelinfo['height'] >= 128:
-                            baselevel = i
-                            break
-                    self.total_texture_updates += len(byte_ranges[baselevel+1:])
-                    
-                    if 'progressive_stream_size' in progressive:
-                        self.total_mesh_refinements += int(math.ceil(progressive['progressive_stream_size'] / float(percepfilter.PM_CHUNK_SIZE)))
-                    
-                    self.update_stats()
+                self.metadata_loaded(t.metadata)
+            elif isinstance(t, metadata.MetadataBatchDownloadTask):
+                for m in t.modelslugs:
+                    self.metadata_loaded(t.metadata[m])
                 
             self.loading_priority -= 1
         
         
-        return task.again
+        return task.cont
 
-    def model_loaded(self, modelpath, modelslug):
+    def queue_metadata(self, manifest, batch_size):
+        """Adds the tasks of every model found in the manifest at once, and
+        queues downloads for the metadata of the rest, batch_size models to a
+        task if batch_size is given"""
+        missing = []
+        for m in self.unique_models:
+            if m in manifest:
+                metadata.add_model_tasks(self.multiplexer, m, manifest[m])
+                self.metadata_loaded(manifest[m])
+            else:
+                missing.append(m)
+        
+        if batch_size is None:
+            for m in missing:
+                t = metadata.MetadataDownloadTask(m)
+                self.multiplexer.add_task(t)
+        else:
+            for i in range(0, len(missing), batch_size):
+                t = metadata.MetadataBatchDownloadTask(missing[i:i + batch_size])
+                self.multiplexer.add_task(t)
+    
+    def metadata_loaded(self, modelmetadata):
+        if self.showstats:
+            self.num_metadata_loaded += 1
+            
+            progressive = modelmetadata['metadata']['types']['progressive']
+            byte_ranges = progressive['mipmaps']['./atlas.jpg']['byte_ranges']
+            baselevel = len(byte_ranges)
+            for i, levelinfo in enumerate(byte_ranges):
+                if levelinfo['width'] >= 128 or levelinfo['height'] >= 128:
+                    baselevel = i
+                    break
+            self.total_texture_updates += len(byte_ranges[baselevel+1:])
+            
+            if 'progressive_stream_size' in progressive:
+                self.total_mesh_refinements += int(math.ceil(progressive['progressive_stream_size'] / float(percepfilter.PM_CHUNK_SIZE)))
+            
+            self.update_stats()
+    
+    def model_loaded(self, modelpath, t):
+        modelslug = t.modelslug
         self.models_loaded.add(modelslug)
-        self.waiting.append((LOAD_TYPE.INITIAL_MODEL, modelpath, modelslug))
-        for pm_refinements in self.pm_waiting[modelslug]:
-            self.waiting.append((LOAD_TYPE.MESH_REFINEMENT, modelslug, pm_refinements))
+        self.waiting.append((LOAD_TYPE.INITIAL_MODEL, t, modelpath, modelslug))
+        for refinement_task in self.pm_waiting[modelslug]:
+            self.pm_waiting_bytes -= _pending_size(refinement_task)
+            self.apply_bytes += _pending_size(refinement_task)
+            self.waiting.append((LOAD_TYPE.MESH_REFINEMENT, refinement_task, modelslug, refinement_task.pm_refinements))
         del self.pm_waiting[modelslug]
     
-    def texture_loaded(self, modelpath, modelslug):
+    def texture_loaded(self, modelpath, t):
+        # the loader can finish a higher level first
+        if t.levelinfo['offset'] <= self.texture_offsets.get(t.modelslug, -1):
+            self.texture_superseded(t)
+            return
+        self.texture_offsets[t.modelslug] = t.levelinfo['offset']
+        
         newtex = modelpath.getChild(0).getTexture()
-        np = self.unique_nodepaths[modelslug]
-        self.waiting.append((LOAD_TYPE.TEXTURE_UPDATE, np, newtex))
+        np = self.unique_nodepaths[t.modelslug]
+        for item in self.waiting.append((LOAD_TYPE.TEXTURE_UPDATE, t, np, newtex)):
+            self.texture_superseded(item[1])
+    
+    def texture_superseded(self, t):
+        self.apply_bytes -= _pending_size(t)
+        trace.record(trace.CANCEL, t, trace.MAIN_THREAD)
+        if self.showstats:
+            # counted as done, since it will never be applied
+            self.num_texture_updates += 1
+            self.update_stats()
         
     def load_waiting(self, task):
-        time_wait = 0.1
-        
-        if len(self.waiting) > 0:
-            t0 = time.time()
-            args = self.waiting.pop(0)
-            if args[0] == LOAD_TYPE.INITIAL_MODEL:
-                modelpath, modelslug = args[1], args[2]
-                
-                np = self.unique_nodepaths[modelslug]
-                modelnode = modelpath.getChild(0)
-                geomnode = modelnode.getChild(0)
-                trans = modelnode.getTransform()
-                geomnode.setTransform(trans)
-                self.unique_nodepaths[modelslug] = geomnode
-                
-                if self.instance_count[modelslug] == 1:
-                    geomnode.reparentTo(np)
-                else:
-                    for instance_np in self.nodepaths_byslug[modelslug]:
-                        geomnode.instanceTo(instance_np)
-                    #self.rigid_body_combiners[modelslug].collect()
-                
-                if self.showstats:
-                    self.num_models_loaded += 1
-                    self.update_stats()
-                
-            elif args[0] == LOAD_TYPE.TEXTURE_UPDATE:
-                np, newtex = args[1], args[2]
-                np.setTextureOff(1)
-                np.setTexture(newtex, 1)
-                if self.showstats:
-                    self.num_texture_updates += 1
-                    self.update_stats()
-            elif args[0] == LOAD_TYPE.MESH_REFINEMENT:
-                modelslug, pm_refinements = args[1], args[2]
-                np = self.unique_nodepaths[modelslug]
-                pdae_updater.update_nodepath(np.node(), pm_refinements)
-                
-                #if self.instance_count[modelslug] > 1:
-                #    self.rigid_body_combiners[modelslug].collect()
-                
-                if self.showstats:
-                    self.num_mesh_refinements += 1
-                    self.update_stats()
+        """Applies waiting work, highest priority models first, until
+        apply_budget seconds of this frame have been spent. At least one item
+        is applied per frame."""
+        if len(self.waiting) == 0:
+            return task.cont
+        
+        deadline = time.time() + self.apply_budget
+        for modelslug in self.waiting.ranked_slugs(self.pandastate):
+            while self.waiting.has_items(modelslug):
+                self.apply(self.waiting.pop(modelslug))
+                if time.time() >= deadline:
+                    return task.cont
+        
+        return task.cont
+    
+    def apply(self, args):
+        if args[0] == LOAD_TYPE.INITIAL_MODEL:
+            modelpath, modelslug = args[2], args[3]
             
-            t1 = time.time()
-            time_took = t1-t0
-            time_wait = time_took * 2.0
-            time_wait = min(time_wait, 1)
-            time_wait = max(time_wait, 0.1)
+            np = self.unique_nodepaths[modelslug]
+            modelnode = modelpath.getChild(0)
+            geomnode = modelnode.getChild(0)
+            trans = modelnode.getTransform()
+            geomnode.setTransform(trans)
+            self.unique_nodepaths[modelslug] = geomnode
+            
+            if self.instance_count[modelslug] == 1:
+                geomnode.reparentTo(np)
+            else:
+                for instance_np in self.nodepaths_byslug[modelslug]:
+                    geomnode.instanceTo(instance_np)
+                #self.rigid_body_combiners[modelslug].collect()
+            
+            if self.showstats:
+                self.num_models_loaded += 1
+                self.update_stats()
+            
+        elif args[0] == LOAD_TYPE.TEXTURE_UPDATE:
+            np, newtex = args[2], args[3]
+            np.setTextureOff(1)
+            np.setTexture(newtex, 1)
+            if self.showstats:
+                self.num_texture_updates += 1
+                self.update_stats()
+        elif args[0] == LOAD_TYPE.MESH_REFINEMENT:
+            modelslug, pm_refinements = args[2], args[3]
+            np = self.unique_nodepaths[modelslug]
+            pdae_updater.update_nodepath(np.node(), pm_refinements)
+            
+            #if self.instance_count[modelslug] > 1:
+            #    self.rigid_body_combiners[modelslug].collect()
+            
+            if self.showstats:
+                self.num_mesh_refinements += 1
+                self.update_stats()
         
-        task.delayTime = time_wait
-        return task.again
+        self.apply_bytes -= _pending_size(args[1])
+        trace.record(trace.APPLY, args[1], trace.MAIN_THREAD)
+
+    def held_task_types(self):
+        """Returns the task types whose results would add to memory that is
+        already past its limit. Past max_apply_bytes, nothing that ends up in
+        the waiting queue is started, and past max_pm_waiting_bytes no more
+        refinements are downloaded until their models load."""
+        apply_full = self.max_apply_bytes is not None and self.apply_bytes > self.max_apply_bytes
+        pm_waiting_full = self.max_pm_waiting_bytes is not None and self.pm_waiting_bytes > self.max_pm_waiting_bytes
+        
+        held = []
+        if apply_full:
+            held.extend([taskbase.LoadTask, taskbase.PipelineTask, texturetask.TextureDownloadTask])
+        if apply_full or pm_waiting_full:
+            held.append(refinementtask.MeshRefinementDownloadTask)
+        return tuple(held)
 
     def trigger_screenshot(self, task):
         if self.start_time is None:
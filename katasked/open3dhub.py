@@ -2,8 +2,15 @@ import json
 import posixpath
 from StringIO import StringIO
 import os
+import multiprocessing.pool
 import requests
 import urlparse
+import threading
+import tempfile
+import time
+import traceback
+
+import numpy
 
 import collada
 from meshtool.filters.panda_filters import pandacore
@@ -13,6 +20,7 @@ from meshtool.filters.print_filters.print_bounds import getBoundsInfo
 import panda3d.core as p3d
 
 import cache
+import cdn
 import panda
 import util
 
@@ -24,6 +32,8 @@ DNS_URL = None
 MODELINFO_URL = None
 SEARCH_URL = None
 
+RECORD_CORPUS = None
+
 PANDA3D = False
 
 PROGRESSIVE_CHUNK_SIZE = 2 * 1024 * 1024 # 2 MB
@@ -33,7 +43,14 @@ TEMPDIR = os.path.join(CURDIR, '.temp_models')
 
 def _get_session():
     return requests.session(timeout=6)
-REQUESTS_SESSION = _get_session()
+
+# each thread gets its own session, since downloads may run on a thread pool
+_thread_state = threading.local()
+
+def _thread_session():
+    if not hasattr(_thread_state, 'session'):
+        _thread_state.session = _get_session()
+    return _thread_state.session
 
 def set_cdn_domain(domain):
     global BASE_DOMAIN, BASE_URL, BROWSE_URL, DOWNLOAD_URL, \
@@ -49,6 +66,13 @@ def set_cdn_domain(domain):
 
 set_cdn_domain('open3dhub.com')
 
+def set_record_corpus(corpus_dir):
+    """Saves every response fetched from the CDN into corpus_dir, which
+    bin/cdn_server.py can then serve. Only what isn't already in the cache is
+    fetched, so recording should start from an empty cache directory."""
+    global RECORD_CORPUS
+    RECORD_CORPUS = None if corpus_dir is None else cdn.Corpus(corpus_dir)
+
 class PathInfo(object):
     """Helper class for dealing with CDN paths"""
     def __init__(self, filename):
@@ -89,7 +113,7 @@ class PathInfo(object):
 def urlfetch(url, httprange=None):
     """Fetches the given URL and returns data from it.
     Will take care of gzip if enabled on server."""
-    global REQUESTS_SESSION
+    session = _thread_session()
     
     headers = {}
     if httprange is not None:
@@ -97,16 +121,18 @@ def urlfetch(url, httprange=None):
         headers['Range'] = 'bytes=%d-%d' % (offset, offset+length-1)
     
     try:
-        resp = REQUESTS_SESSION.get(url, headers=headers)
+        resp = session.get(url, headers=headers)
         # raises HTTPError on non-200 response
         resp.raise_for_status()
     except (requests.HTTPError, requests.Timeout, requests.ConnectionError):
         # close all open connections if we get some error
-        REQUESTS_SESSION.close()
-        REQUESTS_SESSION = _get_session()
+        session.close()
+        _thread_state.session = _get_session()
         # then re-raise so it will retry
         raise
     
+    if RECORD_CORPUS is not None:
+        RECORD_CORPUS.record(url, headers.get('Range'), resp.content)
     return resp.content
     
 def json_fetch(url):
@@ -116,19 +142,38 @@ def json_fetch(url):
         print 'Error receiving json for url', url
         raise
 
-def hashfetch(dlhash, httprange=None):
+def _hash_key_url(dlhash, httprange=None):
+    """Returns the cache key and the download url of a hash or a range of it"""
     key = 'HASH_' + dlhash
     url = DOWNLOAD_URL + '/' + dlhash
     if httprange is not None:
         offset, length = httprange
         key += "_%d_%d" % (offset, length)
         url += "?start=%d&end=%d" % (offset, offset+length-1)
+    return key, url
+
+def hashfetch(dlhash, httprange=None):
+    key, url = _hash_key_url(dlhash, httprange)
     data = cache.cache_data_wrap(key, urlfetch, url)
-    if httprange is not None and len(data) != length:
+    if httprange is not None and len(data) != httprange[1]:
         print 'GOT INCORRECT LENGTH', key, dlhash, httprange, len(data)
-        assert len(data) == length
+        assert len(data) == httprange[1]
     return data
 
+def prefetch_ranges(dlhash, ranges):
+    """Downloads the smallest range of dlhash covering all of ranges, a list of
+    (offset, length), with a single request. Each range is then put in the cache
+    under the key hashfetch looks it up by."""
+    start = min(offset for offset, length in ranges)
+    end = max(offset + length for offset, length in ranges)
+    key, url = _hash_key_url(dlhash, (start, end - start))
+    data = urlfetch(url)
+    assert len(data) == end - start
+    
+    for offset, length in ranges:
+        key, url = _hash_key_url(dlhash, (offset, length))
+        cache.cache_data_wrap(key, lambda piece: piece, data[offset - start:offset - start + length])
+
 def get_subfile_hash(subfile_path):
     subfile_url = DNS_URL + subfile_path
     subfile_json = json.loads(urlfetch(subfile_url))
@@ -158,6 +203,18 @@ def get_metadata(path):
     pathinfo = PathInfo(path)
     return cache.cache_metadata_wrap('METADATA_' + str(path), json_fetch, MODELINFO_URL % {'path': pathinfo.normpath})
 
+def get_metadata_many(paths, num_threads=16):
+    """Returns the metadata of every path in paths, in the same order,
+    fetching up to num_threads of them at once"""
+    if len(paths) == 0:
+        return []
+    pool = multiprocessing.pool.ThreadPool(min(num_threads, len(paths)))
+    try:
+        return pool.map(get_metadata, paths)
+    finally:
+        pool.close()
+        pool.join()
+
 def get_tag(tag):
     return cache.cache_metadata_wrap('TAG_' + tag, get_search_list, 'tags:"%s"' % tag)
 
@@ -228,3 +285,48 @@ def load_into_bamfile(meshdata, boundsInfo, subfiles, modelslug):
     """Uses pycollada and panda3d to load meshdata and subfiles and write out to a bam file on disk"""
     return cache.cache_bam_wrap(modelslug + '.bam', meshdata, boundsInfo, subfiles, modelslug)
 
+def _make_warm_up_mesh():
+    """Returns the bytes of a collada document with a single triangle"""
+    mesh = collada.Collada()
+    effect = collada.material.Effect("effect0", [], "phong", diffuse=(1, 1, 1))
+    mat = collada.material.Material("material0", "material", effect)
+    mesh.effects.append(effect)
+    mesh.materials.append(mat)
+    
+    vert_src = collada.source.FloatSource("verts-array", numpy.array([0, 0, 0, 1, 0, 0, 0, 1, 0], dtype=numpy.float32), ('X', 'Y', 'Z'))
+    normal_src = collada.source.FloatSource("normals-array", numpy.array([0, 0, 1] * 3, dtype=numpy.float32), ('X', 'Y', 'Z'))
+    geom = collada.geometry.Geometry(mesh, "geometry0", "triangle", [vert_src, normal_src])
+    input_list = collada.source.InputList()
+    input_list.addInput(0, 'VERTEX', "#verts-array")
+    input_list.addInput(1, 'NORMAL', "#normals-array")
+    geom.primitives.append(geom.createTriangleSet(numpy.array([0, 0, 1, 1, 2, 2]), input_list, "materialref"))
+    mesh.geometries.append(geom)
+    
+    matnode = collada.scene.MaterialNode("materialref", mat, inputs=[])
+    node = collada.scene.Node("node0", children=[collada.scene.GeometryNode(geom, [matnode])])
+    mesh.scenes.append(collada.scene.Scene("scene0", [node]))
+    mesh.scene = mesh.scenes[0]
+    
+    buf = StringIO()
+    mesh.write(buf)
+    return buf.getvalue()
+
+def warm_up():
+    """Initializer for worker processes that convert meshes. Runs a one triangle
+    mesh through the same collada to bam conversion as load_into_bamfile, so the
+    first real task doesn't pay for lazy imports and first-use initialization."""
+    t0 = time.time()
+    try:
+        boundsInfo = {'center': numpy.zeros(3, dtype=numpy.float32),
+                      'center_farthest_distance': 1.0}
+        np = panda.mesh_to_nodepath(load_mesh(_make_warm_up_mesh(), {}), boundsInfo)
+        fd, bam_file = tempfile.mkstemp(suffix='.bam')
+        os.close(fd)
+        try:
+            np.writeBamFile(bam_file)
+        finally:
+            os.remove(bam_file)
+    except Exception:
+        # a worker that isn't warmed up still works, just slower at first
+        traceback.print_exc()
+    print 'Worker %d warmed up in %.3f seconds' % (os.getpid(), time.time() - t0)
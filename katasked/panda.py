@@ -17,6 +17,115 @@ class PandaState(object):
         """The Panda3D global clock"""
         self.obj_bounds = obj_bounds
         """Sphere bounding boxes for each nodepath"""
+        self.instance_bounds = InstanceBounds(nodepaths, obj_bounds)
+        """The sphere bounding boxes as contiguous arrays, for batch metrics"""
+        self.instance_grid = SpatialGrid(self.instance_bounds)
+        """Uniform grid over instance_bounds, for bounding metrics by region"""
+        self.metrics_cache = None
+        """Cached per-instance metrics, created by katasked.task.priority"""
+
+class InstanceBounds(object):
+    """Bounding spheres of every instance in the scene, stored as contiguous
+    arrays in a fixed row order so metrics can be computed over all of them
+    with a few array operations"""
+    
+    def __init__(self, nodepaths, obj_bounds):
+        self.models = list(nodepaths.iterkeys())
+        """SceneModel of each row"""
+        self.nodepaths = [nodepaths[m] for m in self.models]
+        """NodePath of each row"""
+        self.slug_codes = dict((slug, i) for i, slug in enumerate(sorted(set(m.slug for m in self.models))))
+        """A dict mapping SceneModel.slug to a unique integer code"""
+        self.row_slug_codes = numpy.array([self.slug_codes[m.slug] for m in self.models], dtype=numpy.intp)
+        """Slug code of each row"""
+        self.slug_rows = numpy.argsort(self.row_slug_codes, kind='mergesort')
+        """Row indices grouped by slug code, see rows_for_slugs"""
+        self.slug_offsets = numpy.searchsorted(self.row_slug_codes[self.slug_rows],
+                                               numpy.arange(len(self.slug_codes) + 1))
+        """Start of each slug code's rows in slug_rows, with the end appended"""
+        self.centers = numpy.array([list(obj_bounds[np].getCenter()) for np in self.nodepaths],
+                                   dtype=numpy.float64).reshape(-1, 3)
+        """Nx3 array of bounding sphere centers"""
+        self.radii = numpy.array([obj_bounds[np].getRadius() for np in self.nodepaths], dtype=numpy.float64)
+        """Length N array of bounding sphere radii"""
+        self.max_radius = self.radii.max() if len(self.radii) > 0 else 1.0
+        """Largest radius in the scene, used to normalize scale"""
+    
+    def __len__(self):
+        return len(self.models)
+    
+    def rows_for_slugs(self, codes):
+        """Returns (rows, segment) for an array of slug codes, where rows holds the
+        rows of every given code one after the other and segment holds the
+        position in codes that each row came from"""
+        starts = self.slug_offsets[codes]
+        counts = self.slug_offsets[codes + 1] - starts
+        segment = numpy.repeat(numpy.arange(len(codes)), counts)
+        
+        # position of each row within its own code's run of slug_rows
+        run_starts = numpy.cumsum(counts) - counts
+        within = numpy.arange(counts.sum()) - run_starts[segment]
+        
+        return self.slug_rows[starts[segment] + within], segment
+
+class SpatialGrid(object):
+    """A uniform grid over the centers of an InstanceBounds. Only non-empty
+    cells are kept, each with the tight box around the centers in it and the
+    largest radius in it, so a cell bounds every sphere that falls inside it."""
+    
+    OBJECTS_PER_CELL = 8
+    
+    def __init__(self, bounds):
+        self.bounds = bounds
+        
+        if len(bounds) == 0:
+            self.row_cell = numpy.zeros(0, dtype=numpy.intp)
+            self.cell_lo = numpy.zeros((0, 3))
+            self.cell_hi = numpy.zeros((0, 3))
+            self.cell_max_radius = numpy.zeros(0)
+            return
+        
+        minpt = bounds.centers.min(axis=0)
+        extents = bounds.centers.max(axis=0) - minpt
+        cell_size = self._pick_cell_size(extents, len(bounds) / float(self.OBJECTS_PER_CELL))
+        dims = numpy.maximum(numpy.ceil(extents / cell_size).astype(numpy.intp), 1)
+        
+        coords = numpy.floor((bounds.centers - minpt) / cell_size).astype(numpy.intp)
+        coords = numpy.minimum(coords, dims - 1)
+        flat = numpy.ravel_multi_index(coords.T, dims)
+        
+        cell_ids, self.row_cell = numpy.unique(flat, return_inverse=True)
+        """Index of the cell each row of bounds falls in"""
+        num_cells = len(cell_ids)
+        
+        self.cell_lo = numpy.empty((num_cells, 3))
+        """Minimum corner of the centers in each cell"""
+        self.cell_lo.fill(numpy.inf)
+        numpy.minimum.at(self.cell_lo, self.row_cell, bounds.centers)
+        self.cell_hi = numpy.empty((num_cells, 3))
+        """Maximum corner of the centers in each cell"""
+        self.cell_hi.fill(-numpy.inf)
+        numpy.maximum.at(self.cell_hi, self.row_cell, bounds.centers)
+        self.cell_max_radius = numpy.zeros(num_cells)
+        """Largest sphere radius in each cell"""
+        numpy.maximum.at(self.cell_max_radius, self.row_cell, bounds.radii)
+    
+    @staticmethod
+    def _pick_cell_size(extents, num_cells):
+        # scenes are often flat, so drop axes that are thinner than a cell
+        # and size the cells over the remaining ones
+        active = extents > 0
+        cell_size = 1.0
+        while active.any():
+            cell_size = (numpy.prod(extents[active]) / max(num_cells, 1.0)) ** (1.0 / active.sum())
+            still_active = active & (extents >= cell_size)
+            if (still_active == active).all():
+                break
+            active = still_active
+        return max(cell_size, 1e-9)
+    
+    def __len__(self):
+        return len(self.cell_max_radius)
 
 def centerAndScale(nodePath, boundsInfo):
 
@@ -0,0 +1,32 @@
+import collections
+
+import numpy
+import panda3d.core as p3d
+
+CameraPose = collections.namedtuple('CameraPose', ['pos', 'forward'])
+"""Position and normalized forward vector of the camera, as numpy arrays"""
+
+def pose_from_pos_quat(pos, quat):
+    forward = quat.getForward()
+    forward.normalize()
+    return CameraPose(numpy.array(list(pos), dtype=numpy.float64),
+                      numpy.array(list(forward), dtype=numpy.float64))
+
+def predict_camera_poses(camera, camera_smoother, curtime, horizons):
+    """Returns the current CameraPose of camera followed by one predicted by
+    camera_smoother for each of the given horizons, in seconds from curtime.
+    The smoother is recomputed for every horizon, so each predicted pose has
+    both the position and the orientation of its own horizon."""
+    poses = [pose_from_pos_quat(camera.getPos(), camera.getQuat())]
+    
+    for horizon in horizons:
+        camera_smoother.computeSmoothPosition(curtime + horizon)
+        quat = p3d.Quat()
+        quat.setHpr(camera_smoother.getSmoothHpr())
+        poses.append(pose_from_pos_quat(camera_smoother.getSmoothPos(), quat))
+    
+    return poses
+
+def horizon_name(horizon):
+    """Name used for metrics at the given horizon, e.g. future_2_solid_angle"""
+    return 'future_%g' % horizon
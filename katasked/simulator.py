@@ -0,0 +1,372 @@
+import json
+import heapq
+import itertools
+import collections
+
+import numpy
+import panda3d.core as p3d
+from pandac.PandaModules import SmoothMover
+
+import katasked.panda
+import katasked.motioncap as motioncap
+import katasked.task.pool as pool
+import katasked.task.result as result
+import katasked.task.base as taskbase
+import katasked.task.metadata as metadata
+import katasked.task.mesh as meshtask
+import katasked.task.texture as texturetask
+import katasked.task.refinement as refinementtask
+import katasked.task.prefetch as prefetch
+import katasked.task.priority as priority
+
+POLL_INTERVAL = 0.1
+"""Seconds between polls when no task completes, the shortest wait of ProgressiveLoader.check_pool"""
+
+FIRST_POLL = 0.5
+"""Time of the first poll, as in ProgressiveLoader"""
+
+CAMERA_UPDATE_INTERVAL = 0.1
+"""Seconds between samples of the camera predictor, as in ProgressiveLoader"""
+
+SCREEN_PIXELS = 1024 * 768
+"""Pixel errors are divided by this, so a model that hasn't loaded has an error of 1.0"""
+
+DEFAULT_COSTS = {'MeshLoadTask': (0.05, 2e-6),
+                 'MeshPipelineTask': (0.05, 2e-6),
+                 'TextureDownloadTask': (0.02, 1e-7)}
+"""Rough CPU cost of task types as (seconds, seconds per byte), for when there is no trace to fit"""
+
+def task_size(task):
+    """Bytes a task downloads, or the size of the base mesh it loads"""
+    size = getattr(task, 'download_size', None)
+    if size is None and hasattr(task, 'progressive'):
+        size = task.progressive['size_gzip']
+    return size or 0
+
+def task_fetches(task):
+    """The (hash, httprange) fetches a task makes through open3dhub.hashfetch,
+    which are cached by that key"""
+    if isinstance(task, prefetch.PrefetchTask):
+        return [fetch for stage in task.stages for fetch in stage.fetches]
+    elif isinstance(task, (meshtask.MeshDownloadTask, meshtask.MeshPipelineTask)):
+        mesh_hash, atlas_hash, base_level = meshtask.base_hashes(task.progressive)
+        return [(mesh_hash, None), (atlas_hash, (base_level['offset'], base_level['length']))]
+    elif isinstance(task, texturetask.TextureDownloadTask):
+        atlas_hash = task.progressive['mipmaps']['./atlas.jpg']['hash']
+        return [(atlas_hash, (task.levelinfo['offset'], task.levelinfo['length']))]
+    elif isinstance(task, refinementtask.MeshRefinementDownloadTask):
+        return [(task.progressive_stream_hash, (task.offset, task.length))]
+    return []
+
+class LatencyModel(object):
+    """Time a request takes as a fixed cost plus a cost per byte for its task
+    type. Downloads also wait a round trip and share the bandwidth evenly with
+    the other downloads of their pool running when they start, unless all they
+    fetch is already in the hash cache."""
+    
+    def __init__(self, rtt=0.1, bandwidth=1024 * 1024, costs=None):
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.costs = dict(DEFAULT_COSTS) if costs is None else costs
+    
+    def seconds(self, task, running, cached=False):
+        """How long task takes while running other tasks of its pool are in
+        flight. cached is True if everything the task fetches is in the hash
+        cache, so it costs no time on the link."""
+        size = task_size(task)
+        fixed, per_byte = self.costs.get(type(task).__name__, (0.0, 0.0))
+        seconds = fixed + per_byte * size
+        if isinstance(task, (taskbase.DownloadTask, taskbase.PipelineTask)) and not cached:
+            seconds += self.rtt + size * (running + 1) / float(self.bandwidth)
+        return seconds
+
+class TraceLatencyModel(LatencyModel):
+    """Latencies fitted to a trace written by loadscene.py --trace. The running
+    time of each task type is fitted as a fixed cost plus a cost per byte,
+    which already includes the network and the contention of the recorded
+    run. Task types missing from the trace fall back to LatencyModel."""
+    
+    def __init__(self, tracefile, **kwargs):
+        super(TraceLatencyModel, self).__init__(**kwargs)
+        self.fitted = {}
+        for name, points in self._running_spans(json.load(tracefile)).iteritems():
+            sizes, seconds = numpy.array(points, dtype=numpy.float64).T
+            if len(points) > 1 and sizes.ptp() > 0:
+                per_byte, fixed = numpy.polyfit(sizes, seconds, 1)
+                self.fitted[name] = (max(fixed, 0.0), max(per_byte, 0.0))
+            else:
+                self.fitted[name] = (seconds.mean(), 0.0)
+    
+    @staticmethod
+    def _running_spans(trace):
+        """Returns a dict mapping task type names to lists of (bytes, seconds)"""
+        spans = collections.defaultdict(list)
+        begins = {}
+        for event in trace['traceEvents']:
+            if event.get('name') != 'running':
+                continue
+            if event['ph'] == 'b':
+                begins[event['id']] = event
+            elif event['ph'] == 'e' and event['id'] in begins:
+                begin = begins.pop(event['id'])
+                spans[begin['args']['task']].append((begin['args'].get('bytes', 0),
+                                                     (event['ts'] - begin['ts']) / 1e6))
+        return spans
+    
+    def seconds(self, task, running, cached=False):
+        name = type(task).__name__
+        # the fitted costs include the network, which a cache hit skips
+        if name not in self.fitted or cached:
+            return super(TraceLatencyModel, self).seconds(task, running, cached)
+        fixed, per_byte = self.fitted[name]
+        return fixed + per_byte * task_size(task)
+
+def _fake_result(task, corpus):
+    """What the job of task would have returned, as far as its finished needs"""
+    if isinstance(task, metadata.MetadataDownloadTask):
+        return corpus[task.modelslug]
+    elif isinstance(task, metadata.MetadataBatchDownloadTask):
+        return [corpus[m] for m in task.modelslugs]
+    elif isinstance(task, refinementtask.MeshRefinementDownloadTask):
+        return (task.refinements_read, task.num_refinements, [], '')
+    elif isinstance(task, meshtask.MeshDownloadTask):
+        return (None, None)
+    elif isinstance(task, prefetch.PrefetchTask):
+        return True
+    # BAM file paths, which are never loaded
+    return None
+
+class _SimResult(object):
+    """Stands in for the AsyncResult of a task, see pool._call_catching"""
+    
+    def __init__(self, value):
+        self.value = value
+    
+    def get(self):
+        return None, self.value, None
+
+class SimTaskPool(pool.TaskPool):
+    """A TaskPool that doesn't run its tasks. Each request completes at the
+    simulated time given by the Simulator's latency model."""
+    
+    LOG_TASKS = False
+    
+    def __init__(self, simulator, num_procs, **kwargs):
+        self.simulator = simulator
+        super(SimTaskPool, self).__init__(num_procs, **kwargs)
+    
+    def clock(self):
+        return self.simulator.clock.getFrameTime()
+    
+    def _start_workers(self, num_workers, initializer):
+        return None
+    
+    def _add_workers(self, num_workers):
+        self.num_workers = num_workers
+    
+    def _start_task(self, task, now):
+        key = next(self.completion_keys)
+        self.running[key] = result.TaskResult(task=task,
+                                              result=_SimResult(_fake_result(task, self.simulator.corpus)),
+                                              started=now)
+        fetches = task_fetches(task)
+        cached = len(fetches) > 0 and all(fetch in self.simulator.cached for fetch in fetches)
+        seconds = self.simulator.latency.seconds(task, len(self.running) - 1, cached)
+        self.simulator.schedule(now + seconds, self, key)
+
+class SimMultiplexPool(pool.MultiplexPool):
+    """A MultiplexPool of SimTaskPools"""
+    
+    def __init__(self, simulator, **kwargs):
+        self.simulator = simulator
+        super(SimMultiplexPool, self).__init__(**kwargs)
+    
+    def _make_pool(self, num_procs, **kwargs):
+        return SimTaskPool(self.simulator, num_procs, **kwargs)
+
+class SimClock(object):
+    """Stands in for the Panda3D global clock"""
+    
+    def __init__(self):
+        self.now = 0.0
+    
+    def getFrameTime(self):
+        return self.now
+
+def estimate_error(progressive, width, height, stream_fraction):
+    """Pixel error of a model showing the given texture size after
+    stream_fraction of its progressive stream has been applied. The triangle
+    count is taken to grow linearly over the stream, from the base mesh to the
+    most detailed level in progressive_perceptual_error."""
+    levels = progressive['progressive_perceptual_error']
+    base_triangles = levels[0]['triangles']
+    max_triangles = max(level['triangles'] for level in levels)
+    triangles = base_triangles + stream_fraction * (max_triangles - base_triangles)
+    
+    candidates = [level for level in levels if level['width'] == width and level['height'] == height]
+    if len(candidates) == 0:
+        return levels[0]['pixel_error']
+    reached = [level for level in candidates if level['triangles'] <= triangles]
+    if len(reached) > 0:
+        return max(reached, key=lambda level: level['triangles'])['pixel_error']
+    return min(candidates, key=lambda level: level['triangles'])['pixel_error']
+
+class Simulator(object):
+    """Replays a motion capture over a scene against a SimMultiplexPool and the
+    real task classes, in simulated time. Every sample_interval seconds it
+    estimates the error of the view as the average of the error of each
+    instance in view, weighted by its solid angle, where a model that hasn't
+    loaded has an error of 1.0. Finished work is counted as applied as soon as
+    it completes."""
+    
+    def __init__(self, scenemodels, capturedata, corpus, latency=None, sample_interval=0.5, metadata_batch=None,
+                 **pool_options):
+        """corpus maps each model slug to its metadata, see
+        katasked.task.metadata.load_manifest. Metadata is downloaded
+        metadata_batch models to a task if it's given, and pool_options are
+        passed on to MultiplexPool."""
+        self.corpus = corpus
+        self.latency = LatencyModel() if latency is None else latency
+        self.sample_interval = sample_interval
+        self.clock = SimClock()
+        self.completions = []
+        self.completion_order = itertools.count()
+        self.cached = set()
+        """(hash, httprange) of every completed fetch, standing in for the hash cache"""
+        
+        nodepaths = {}
+        obj_bounds = {}
+        unique_nodepaths = {}
+        for model in scenemodels:
+            np = p3d.NodePath(model.slug)
+            np.setPos(model.x, model.y, model.z)
+            np.setScale(model.scale, model.scale, model.scale)
+            nodepaths[model] = np
+            obj_bounds[np] = p3d.BoundingSphere(np.getPos(), np.getScale()[0])
+            unique_nodepaths.setdefault(model.slug, np)
+        
+        lens = p3d.PerspectiveLens()
+        lens.setAspectRatio(1024.0 / 768.0)
+        self.camera = p3d.NodePath(p3d.Camera('camera', lens))
+        
+        self.duration = capturedata['duration']
+        curve_creator = motioncap.CreateNurbsCurve()
+        for pos, rot in zip(capturedata['positions'], capturedata['rotations']):
+            curve_creator.addPoint(pos, rot)
+        self.mopath = curve_creator.getMotionPath()
+        
+        self.smooth_mover = SmoothMover()
+        self.smooth_mover.setPredictionMode(SmoothMover.PMOn)
+        self.smooth_mover.setSmoothMode(SmoothMover.SMOn)
+        self.smooth_mover.setMaxPositionAge(10.0)
+        self.smooth_mover.setAcceptClockSkew(False)
+        self.smooth_mover.setDelay(0)
+        
+        self.pandastate = katasked.panda.PandaState(self.camera,
+                                                    unique_nodepaths,
+                                                    nodepaths,
+                                                    self.smooth_mover,
+                                                    self.clock,
+                                                    obj_bounds)
+        
+        bounds = self.pandastate.instance_bounds
+        self.errors = numpy.ones(len(bounds.slug_codes), dtype=numpy.float64)
+        """Current error of each model, by slug code"""
+        self.quality = {}
+        """[texture width, texture height, fraction of the progressive stream] of each loaded model"""
+        self.finished_loading = None
+        """Simulated seconds at which the pools last ran out of work, like
+        FINISHED LOADING in the loader, or None if they still have some.
+        Tasks deferred by defer_hidden don't count as work."""
+        
+        self.multiplexer = SimMultiplexPool(self, **pool_options)
+        slugs = sorted(bounds.slug_codes)
+        if metadata_batch is None:
+            for m in slugs:
+                self.multiplexer.add_task(metadata.MetadataDownloadTask(m))
+        else:
+            for i in range(0, len(slugs), metadata_batch):
+                self.multiplexer.add_task(metadata.MetadataBatchDownloadTask(slugs[i:i + metadata_batch]))
+    
+    def schedule(self, finish_time, taskpool, key):
+        """Completes the request key of taskpool at finish_time"""
+        heapq.heappush(self.completions, (finish_time, next(self.completion_order), taskpool, key))
+    
+    def run(self):
+        """Runs the simulation for the duration of the capture and returns a
+        list of (time, error) samples"""
+        curve = []
+        next_camera = 0.0
+        next_poll = FIRST_POLL
+        next_sample = 0.0
+        
+        while next_sample <= self.duration:
+            now = min(next_camera, next_poll, next_sample)
+            if len(self.completions) > 0:
+                now = min(now, self.completions[0][0])
+            self.clock.now = now
+            self.mopath.goTo(self.camera, min(now / self.duration, 1.0) * self.mopath.getMaxT())
+            
+            if now >= next_camera:
+                self.smooth_mover.setPos(self.camera.getPos())
+                self.smooth_mover.setHpr(self.camera.getHpr())
+                self.smooth_mover.setTimestamp(now)
+                self.smooth_mover.markPosition()
+                next_camera += CAMERA_UPDATE_INTERVAL
+            
+            completed = False
+            while len(self.completions) > 0 and self.completions[0][0] <= now:
+                finish_time, order, taskpool, key = heapq.heappop(self.completions)
+                self.cached.update(task_fetches(taskpool.running[key].task))
+                taskpool.completed.put((key, finish_time))
+                completed = True
+            
+            reprioritize = now >= next_poll
+            if completed or reprioritize:
+                for task in self.multiplexer.poll(self.pandastate, reprioritize):
+                    self.task_finished(task)
+                if reprioritize:
+                    next_poll = now + POLL_INTERVAL
+                
+                if not self.multiplexer.empty(include_deferred=False):
+                    self.finished_loading = None
+                elif self.finished_loading is None:
+                    self.finished_loading = now
+            
+            if now >= next_sample:
+                curve.append((now, self.view_error()))
+                next_sample += self.sample_interval
+        
+        return curve
+    
+    def task_finished(self, task):
+        """Updates the error of the model of a finished task"""
+        modelslug = task.modelslug
+        if isinstance(task, (meshtask.MeshLoadTask, meshtask.MeshPipelineTask)):
+            base_level = task.progressive['progressive_perceptual_error'][0]
+            self.quality[modelslug] = [base_level['width'], base_level['height'], 0.0]
+        elif isinstance(task, texturetask.TextureDownloadTask):
+            self.quality[modelslug][0:2] = [task.levelinfo['width'], task.levelinfo['height']]
+        elif isinstance(task, refinementtask.MeshRefinementDownloadTask):
+            self.quality[modelslug][2] = float(task.offset + task.length) / task.progressive_stream_size
+        else:
+            return
+        
+        error = estimate_error(task.progressive, *self.quality[modelslug])
+        self.errors[self.pandastate.instance_bounds.slug_codes[modelslug]] = min(error / float(SCREEN_PIXELS), 1.0)
+    
+    def view_error(self):
+        """Error of the current view, see Simulator"""
+        bounds = self.pandastate.instance_bounds
+        pose = priority.get_camera_poses(self.pandastate)[0]
+        weights = priority.calc_solid_angle(pose.pos, bounds.centers, bounds.radii)
+        weights = weights * priority.calc_visible_rows(self.pandastate, [pose])
+        total = weights.sum()
+        if total == 0:
+            return 0.0
+        return float((weights * self.errors[bounds.row_slug_codes]).sum() / total)
+
+def mean_error(curve):
+    """Mean error of the samples returned by Simulator.run, which are evenly
+    spaced in time"""
+    return sum(error for t, error in curve) / len(curve) if len(curve) > 0 else 0.0
@@ -0,0 +1,52 @@
+import os
+import mmap
+import atexit
+import shutil
+import tempfile
+import collections
+
+SpoolHandle = collections.namedtuple('SpoolHandle', ['path', 'size'])
+"""Refers to a payload written to the spool, cheap to pass between processes"""
+
+# prefer a memory backed filesystem so spooled payloads never touch the disk
+SHARED_MEMORY_DIR = '/dev/shm'
+
+_spool_dir = None
+
+def init_spool(parent_dir=None):
+    """Creates the spool directory. Should be called in the main process before
+    worker pools are started, so that they share it. The directory is removed
+    when the main process exits."""
+    global _spool_dir
+    if parent_dir is None and os.path.isdir(SHARED_MEMORY_DIR):
+        parent_dir = SHARED_MEMORY_DIR
+    _spool_dir = tempfile.mkdtemp(prefix='katasked-spool-', dir=parent_dir)
+    atexit.register(shutil.rmtree, _spool_dir, True)
+
+def put(data):
+    """Writes data to the spool and returns a SpoolHandle for it"""
+    if _spool_dir is None:
+        init_spool()
+    fd, path = tempfile.mkstemp(dir=_spool_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return SpoolHandle(path, len(data))
+
+def get(handle):
+    """Returns the data a SpoolHandle refers to, mapped from the spool file
+    instead of read through a buffer"""
+    if handle.size == 0:
+        return ''
+    with open(handle.path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), handle.size, access=mmap.ACCESS_READ)
+        try:
+            return mapped[:]
+        finally:
+            mapped.close()
+
+def release(handle):
+    """Removes a payload from the spool"""
+    try:
+        os.remove(handle.path)
+    except OSError:
+        pass
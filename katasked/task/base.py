@@ -32,3 +32,7 @@ class DownloadTask(Task):
 class LoadTask(Task):
     """Base task class for loading something"""
     pass
+
+class PipelineTask(Task):
+    """Base task class for downloading something and loading it in a single job"""
+    pass
@@ -1,14 +1,35 @@
 import katasked.task.base as base
 import katasked.open3dhub as open3dhub
+import katasked.spool as spool
 import katasked.task.texture as texturetask
 import katasked.task.refinement as refinementtask
 import katasked.scene as scene
 
+def base_hashes(progressive):
+    """Returns (mesh hash, atlas hash, atlas level info) of the base mesh and its
+    texture, the first texture level of at least 128x128"""
+    mesh_hash = progressive['hash']
+    atlas_ranges = progressive['mipmaps']['./atlas.jpg']['byte_ranges']
+    atlas_hash = progressive['mipmaps']['./atlas.jpg']['hash']
+    
+    base_level = None
+    for levelinfo in atlas_ranges:
+        base_level = levelinfo
+        if levelinfo['width'] >= 128 or levelinfo['height'] >= 128:
+            break
+    
+    return mesh_hash, atlas_hash, base_level
+
+def _fetch_base(mesh_hash, atlas_hash, base_level):
+    mesh_data = open3dhub.hashfetch(mesh_hash)
+    texture_data = open3dhub.hashfetch(atlas_hash, httprange=(base_level['offset'], base_level['length']))
+    return (mesh_data, texture_data)
+
 def _run_download(mesh_hash, atlas_hash, base_level):
     with base.print_exc_onerror():
-        mesh_data = open3dhub.hashfetch(mesh_hash)
-        texture_data = open3dhub.hashfetch(atlas_hash, httprange=(base_level['offset'], base_level['length']))
-        return (mesh_data, texture_data)
+        mesh_data, texture_data = _fetch_base(mesh_hash, atlas_hash, base_level)
+        # spooled so only handles pass through the main process on the way to the load pool
+        return (spool.put(mesh_data), spool.put(texture_data))
 
 class MeshDownloadTask(base.DownloadTask):
     """Downloads the base mesh and texture of a progressive mesh"""
@@ -23,17 +44,7 @@ class MeshDownloadTask(base.DownloadTask):
         self.perceptual_error = self.progressive['progressive_perceptual_error'][0]["pixel_error"]
 
     def run(self):
-        progressive = self.metadata['metadata']['types']['progressive']
-        mesh_hash = progressive['hash']
-        atlas_ranges = progressive['mipmaps']['./atlas.jpg']['byte_ranges']
-        atlas_hash = progressive['mipmaps']['./atlas.jpg']['hash']
-        
-        base_level = None
-        for levelinfo in atlas_ranges:
-            base_level = levelinfo
-            if levelinfo['width'] >= 128 or levelinfo['height'] >= 128:
-                break
-        
+        mesh_hash, atlas_hash, base_level = base_hashes(self.progressive)
         return self.pool.apply_async(_run_download, [mesh_hash, atlas_hash, base_level])
 
     def finished(self, result):
@@ -45,12 +56,19 @@ class MeshDownloadTask(base.DownloadTask):
     def __repr__(self):
         return str(self)
 
-def _run_load(mesh_data, boundsInfo, texture_data, modelslug):
+def _run_load(mesh_handle, boundsInfo, texture_handle, modelslug):
     with base.print_exc_onerror():
-        return open3dhub.load_into_bamfile(mesh_data, boundsInfo, {'atlas.jpg': texture_data}, modelslug)
+        try:
+            mesh_data = spool.get(mesh_handle)
+            texture_data = spool.get(texture_handle)
+            return open3dhub.load_into_bamfile(mesh_data, boundsInfo, {'atlas.jpg': texture_data}, modelslug)
+        finally:
+            spool.release(mesh_handle)
+            spool.release(texture_handle)
 
 class MeshLoadTask(base.LoadTask):
-    """Takes raw base mesh download data and turns it into a BAM ready to load on disk"""
+    """Takes raw base mesh download data and turns it into a BAM ready to load on disk.
+    The data is passed as katasked.spool handles."""
     
     def __init__(self, modelslug, metadata, mesh_data, texture_data):
         super(MeshLoadTask, self).__init__(modelslug)
@@ -71,23 +89,62 @@ class MeshLoadTask(base.LoadTask):
 
     def finished(self, result):
         self.bam_file = result
+        _add_refinement_tasks(self)
+
+    def __str__(self):
+        return '<MeshLoadTask %s>' % self.modelslug
+    def __repr__(self):
+        return str(self)
+
+def _add_refinement_tasks(task):
+    """Queues the texture and mesh refinements that follow the base mesh of task"""
+    base_loaded = task.progressive['progressive_perceptual_error'][0]
+    
+    # add next texture level if exists (> 128x128)
+    atlas_ranges = task.progressive['mipmaps']['./atlas.jpg']['byte_ranges']
+    for levelinfo in atlas_ranges:
+        if levelinfo['width'] > 128 or levelinfo['height'] > 128:
+            t = texturetask.TextureDownloadTask(task.modelslug, task.metadata, levelinfo, base_loaded)
+            task.multiplexer.add_task(t)
+            break
         
-        base_loaded = self.progressive['progressive_perceptual_error'][0]
+    progressive_stream = task.progressive['progressive_stream']
+    if progressive_stream is not None:
+        t = refinementtask.MeshRefinementDownloadTask(task.modelslug, task.metadata, loaded_already=base_loaded)
+        task.multiplexer.add_task(t)
+
+def _run_pipeline(mesh_hash, atlas_hash, base_level, boundsInfo, modelslug):
+    with base.print_exc_onerror():
+        mesh_data, texture_data = _fetch_base(mesh_hash, atlas_hash, base_level)
+        return open3dhub.load_into_bamfile(mesh_data, boundsInfo, {'atlas.jpg': texture_data}, modelslug)
+
+class MeshPipelineTask(base.PipelineTask):
+    """Downloads the base mesh and texture of a progressive mesh and turns them
+    into a BAM on disk in one job, instead of a MeshDownloadTask followed by a
+    MeshLoadTask. The data stays in the worker and there's no second wait in a queue."""
+    
+    def __init__(self, modelslug, metadata):
+        super(MeshPipelineTask, self).__init__(modelslug)
+        self.metadata = metadata
+        self.progressive = self.metadata['metadata']['types']['progressive']
+        self.boundsInfo = scene.SceneModel.extract_bounds_info(self.metadata)
+        self.download_size = self.progressive['size_gzip']
         
-        # add next texture level if exists (> 128x128)
-        atlas_ranges = self.progressive['mipmaps']['./atlas.jpg']['byte_ranges']
-        for levelinfo in atlas_ranges:
-            if levelinfo['width'] > 128 or levelinfo['height'] > 128:
-                t = texturetask.TextureDownloadTask(self.modelslug, self.metadata, levelinfo, base_loaded)
-                self.multiplexer.add_task(t)
-                break
-            
-        progressive_stream = self.progressive['progressive_stream']
-        if progressive_stream is not None:
-            t = refinementtask.MeshRefinementDownloadTask(self.modelslug, self.metadata, loaded_already=base_loaded)
-            self.multiplexer.add_task(t)
+        self.perceptual_error = self.progressive['progressive_perceptual_error'][0]["pixel_error"]
+
+    def run(self):
+        mesh_hash, atlas_hash, base_level = base_hashes(self.progressive)
+        return self.pool.apply_async(_run_pipeline, [mesh_hash, atlas_hash, base_level, self.boundsInfo, self.modelslug])
+
+    def _update_loaded_already(self, loaded_already):
+        # no need to update perceptual error here, texture and refinement tasks get loaded after this
+        pass
+
+    def finished(self, result):
+        self.bam_file = result
+        _add_refinement_tasks(self)
 
     def __str__(self):
-        return '<MeshLoadTask %s>' % self.modelslug
+        return '<MeshPipelineTask %s>' % self.modelslug
     def __repr__(self):
         return str(self)
@@ -1,3 +1,5 @@
+import json
+
 import katasked.task.base as base
 import katasked.scene as scene
 import katasked.open3dhub as open3dhub
@@ -7,6 +9,26 @@ def _run(path):
     with base.print_exc_onerror():
         return open3dhub.get_metadata(path)
 
+def _run_batch(paths):
+    with base.print_exc_onerror():
+        return open3dhub.get_metadata_many(paths)
+
+def add_model_tasks(multiplexer, modelslug, metadata):
+    """Adds the tasks that follow once a model's metadata is known"""
+    if multiplexer.prefetcher is not None:
+        multiplexer.prefetcher.add_model(modelslug, metadata)
+    if multiplexer.pipeline:
+        t = meshtask.MeshPipelineTask(modelslug, metadata)
+    else:
+        t = meshtask.MeshDownloadTask(modelslug, metadata)
+    multiplexer.add_task(t)
+
+def load_manifest(f):
+    """Reads a scene manifest, a JSON object mapping model paths to their
+    metadata, and returns it as a dict keyed by model slug"""
+    manifest = json.load(f)
+    return dict((path.replace('/', '~'), metadata) for path, metadata in manifest.iteritems())
+
 class MetadataDownloadTask(base.DownloadTask):
     """Downloads metadata about a model"""
     
@@ -26,10 +48,33 @@ class MetadataDownloadTask(base.DownloadTask):
 
     def finished(self, result):
         self.metadata = result
-        t = meshtask.MeshDownloadTask(self.modelslug, result)
-        self.multiplexer.add_task(t)
+        add_model_tasks(self.multiplexer, self.modelslug, result)
 
     def __str__(self):
         return '<MetadataDownloadTask %s>' % self.modelslug
     def __repr__(self):
         return str(self)
+
+class MetadataBatchDownloadTask(base.DownloadTask):
+    """Downloads metadata about many models at once, in parallel"""
+    
+    def __init__(self, modelslugs):
+        # prioritized as its first model
+        super(MetadataBatchDownloadTask, self).__init__(modelslugs[0])
+        self.modelslugs = modelslugs
+        self.download_size = 1024 * 5 * len(modelslugs)
+        self.perceptual_error = 0
+    
+    def run(self):
+        paths = [scene.SceneModel.unslug(m) for m in self.modelslugs]
+        return self.pool.apply_async(_run_batch, [paths])
+
+    def finished(self, result):
+        self.metadata = dict(zip(self.modelslugs, result))
+        for modelslug, metadata in zip(self.modelslugs, result):
+            add_model_tasks(self.multiplexer, modelslug, metadata)
+
+    def __str__(self):
+        return '<MetadataBatchDownloadTask %s +%d>' % (self.modelslug, len(self.modelslugs) - 1)
+    def __repr__(self):
+        return str(self)
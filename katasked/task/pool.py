@@ -1,109 +1,738 @@
 import multiprocessing
+import multiprocessing.pool
+import Queue
 import time
+import threading
+import itertools
 import collections
 import katasked.task.priority as priority
 import katasked.task.result as result
 import katasked.task.base as taskbase
+import katasked.task.scheduler as scheduler
+import katasked.task.prefetch as prefetchtask
+import katasked.task.texture as texturetask
+import katasked.task.refinement as refinementtask
+import katasked.spool as spool
+import katasked.trace as trace
+import katasked.open3dhub as open3dhub
+
+_worker = threading.local()
+"""Per worker state of _call_catching. Threaded pools run their workers in one
+process, so each worker thread keeps its own count of tasks run."""
+
+def _call_catching(func, args, kwds):
+    """Runs func in a worker process, returning (exception, None, seconds) if it
+    raises and (None, result, seconds) otherwise. Pool.apply_async only calls its
+    callback on success, so errors are returned to make sure a callback always
+    happens. seconds is how long func took if this was the first task of the
+    worker, and None after that."""
+    tasks_run = getattr(_worker, 'tasks_run', 0)
+    first = tasks_run == 0
+    _worker.tasks_run = tasks_run + 1
+    
+    t0 = time.time()
+    try:
+        ex, res = None, func(*args, **kwds)
+    except Exception, ex:
+        res = None
+    
+    return ex, res, time.time() - t0 if first else None
+
+class IndexedHeap(object):
+    """A binary max-heap of items ordered by priority. Keeps the position of
+    each item in the heap, so an item's priority can be changed or the item
+    removed in O(log n)."""
+    
+    def __init__(self):
+        self.heap = []
+        self.position = {}
+        self.priorities = {}
+    
+    def __len__(self):
+        return len(self.heap)
+    
+    def __iter__(self):
+        return iter(self.heap)
+    
+    def __contains__(self, item):
+        return item in self.position
+    
+    def get_priority(self, item):
+        return self.priorities[item]
+    
+    def push(self, item, priority=0.0):
+        """Adds item to the heap with the given priority"""
+        self.heap.append(item)
+        self.position[item] = len(self.heap) - 1
+        self.priorities[item] = priority
+        self._sift_up(len(self.heap) - 1)
+    
+    def update(self, item, priority):
+        """Changes the priority of an item already in the heap"""
+        old_priority = self.priorities[item]
+        self.priorities[item] = priority
+        if priority > old_priority:
+            self._sift_up(self.position[item])
+        elif priority < old_priority:
+            self._sift_down(self.position[item])
+    
+    def remove(self, item):
+        """Removes an item from the heap"""
+        pos = self.position.pop(item)
+        del self.priorities[item]
+        last = self.heap.pop()
+        if pos < len(self.heap):
+            self.heap[pos] = last
+            self.position[last] = pos
+            self._sift_up(pos)
+            self._sift_down(self.position[last])
+    
+    def pop(self):
+        """Removes and returns the highest priority item"""
+        item = self.heap[0]
+        self.remove(item)
+        return item
+    
+    def _swap(self, i, j):
+        heap = self.heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self.position[heap[i]] = i
+        self.position[heap[j]] = j
+    
+    def _sift_up(self, pos):
+        heap, priorities = self.heap, self.priorities
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if priorities[heap[pos]] <= priorities[heap[parent]]:
+                break
+            self._swap(pos, parent)
+            pos = parent
+    
+    def _sift_down(self, pos):
+        heap, priorities = self.heap, self.priorities
+        size = len(heap)
+        while True:
+            largest = pos
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < size and priorities[heap[child]] > priorities[heap[largest]]:
+                    largest = child
+            if largest == pos:
+                break
+            self._swap(pos, largest)
+            pos = largest
+
+class ThroughputMeter(object):
+    """Estimates the bytes per second a pool completes, as an exponentially
+    weighted average of samples. Only time spent with tasks running counts."""
+    
+    def __init__(self, initial_rate, sample_seconds=0.5, smoothing=0.25):
+        self.rate = float(initial_rate)
+        self.sample_seconds = sample_seconds
+        self.smoothing = smoothing
+        self.sample_bytes = 0
+        self.sample_time = 0.0
+        self.last_time = None
+    
+    def update(self, now, busy, completed_bytes):
+        """Records completed_bytes finishing at time now. busy is True if the
+        pool had tasks running since the last update."""
+        if busy and self.last_time is not None:
+            self.sample_time += now - self.last_time
+        self.last_time = now
+        self.sample_bytes += completed_bytes
+        
+        if self.sample_time >= self.sample_seconds:
+            sample_rate = self.sample_bytes / self.sample_time
+            self.rate += self.smoothing * (sample_rate - self.rate)
+            self.sample_bytes = 0
+            self.sample_time = 0.0
+
+class ConcurrencyController(object):
+    """Adjusts how many tasks a pool runs at once by the goodput it would get
+    for a typical task at each limit. A task's latency is taken to be an
+    overhead per request plus a transfer time per byte, and the overhead is
+    fitted by least squares over the last fit_tasks tasks. Every interval, the
+    transfer time per byte of the tasks that completed, their latencies less
+    the overhead over their total bytes, is recorded against the limit. From
+    it, a task of the average recent size takes the overhead plus that size
+    times the transfer time, and limit such tasks at once give the pool's
+    goodput in bytes per second. Neither depends on how small and large tasks
+    happened to be mixed in an interval, unlike their latency per byte.
+    
+    The limit grows by one while tasks are waiting for a free slot and the
+    goodput at the limit beats that at every lower limit by at least gain
+    times what the extra tasks would add if goodput grew in proportion to
+    the limit. Otherwise the extra tasks only wait on each other for the
+    network or CPU, and the limit is cut. Intervals in which the overhead
+    makes up most of the latency say little about transfer and aren't
+    recorded. Only the last history intervals are compared, so the limit
+    follows lasting changes of the link."""
+    
+    def __init__(self, initial, minimum, maximum, interval=1.0, gain=0.25, decrease=0.75, history=30,
+                 fit_tasks=256):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.gain = gain
+        self.decrease = decrease
+        self.transfer_costs = collections.deque(maxlen=history)
+        """(limit, transfer seconds per byte) of each of the last history recorded intervals"""
+        self.samples = collections.deque(maxlen=fit_tasks)
+        """(bytes, seconds) of the last fit_tasks tasks"""
+        self.completed = []
+        self.saturated = False
+        self.last_adjust = None
+    
+    def record(self, size, seconds):
+        """Records a completed task of size bytes that took seconds"""
+        self.samples.append((size, seconds))
+        self.completed.append((size, seconds))
+    
+    def overhead(self):
+        """Seconds per task that don't depend on its size, fitted over the
+        recorded tasks. With too little spread in task sizes to tell overhead
+        from transfer time, it's taken to be 0."""
+        n = float(len(self.samples))
+        mean_size = sum(size for size, seconds in self.samples) / n
+        mean_seconds = sum(seconds for size, seconds in self.samples) / n
+        var_size = sum((size - mean_size) ** 2 for size, seconds in self.samples) / n
+        if var_size <= (0.1 * mean_size) ** 2:
+            return 0.0
+        
+        covariance = sum((size - mean_size) * (seconds - mean_seconds) for size, seconds in self.samples) / n
+        overhead = mean_seconds - covariance / var_size * mean_size
+        return max(0.0, min(overhead, min(seconds for size, seconds in self.samples)))
+    
+    def update(self, now, saturated):
+        """Returns the current limit. saturated is True if tasks were waiting
+        while the pool was running as many tasks as the limit allows."""
+        self.saturated = self.saturated or saturated
+        if self.last_adjust is None:
+            self.last_adjust = now
+        if now - self.last_adjust < self.interval:
+            return int(self.limit)
+        
+        if len(self.completed) > 0:
+            overhead = self.overhead()
+            total_seconds = sum(seconds for size, seconds in self.completed)
+            transfer_seconds = total_seconds - overhead * len(self.completed)
+            
+            if transfer_seconds >= 0.1 * total_seconds:
+                limit = int(self.limit)
+                self.transfer_costs.append((limit, transfer_seconds / sum(size for size, seconds in self.completed)))
+                
+                if not self._scales(limit, overhead):
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                elif self.saturated:
+                    self.limit = min(self.maximum, self.limit + 1)
+        
+        self.completed = []
+        self.saturated = False
+        self.last_adjust = now
+        return int(self.limit)
+    
+    def _scales(self, limit, overhead):
+        """Returns True if the goodput at limit beats that at every lower limit
+        by enough to keep adding tasks"""
+        by_limit = collections.defaultdict(list)
+        for interval_limit, cost in self.transfer_costs:
+            by_limit[interval_limit].append(cost)
+        
+        mean_size = sum(size for size, seconds in self.samples) / float(len(self.samples))
+        goodputs = {}
+        for interval_limit, costs in by_limit.iteritems():
+            task_seconds = overhead + mean_size * sum(costs) / len(costs)
+            goodputs[interval_limit] = interval_limit * mean_size / task_seconds
+        
+        for lower, goodput in goodputs.iteritems():
+            if lower < limit and goodputs[limit] < goodput * (1.0 + self.gain * (limit - lower) / lower):
+                return False
+        return True
 
 class TaskPool(object):
     """A task pool for running tasks"""
     
-    def __init__(self, num_procs, type_name=""):
-        """Initializes the pool with given number of processes"""
+    INITIAL_THROUGHPUT = 512 * 1024
+    """Bytes per second assumed for a byte budgeted pool before any task finishes"""
+    
+    BUDGET_LOOKAHEAD = 64
+    """Most queued tasks considered for a byte budget at a time"""
+    
+    LOG_TASKS = True
+    """Print tasks as they start and finish"""
+    
+    clock = time.time
+    """Returns the current time in seconds, see katasked.simulator"""
+    
+    def __init__(self, num_procs, type_name="", scheduler=None, budget_seconds=None, threaded=False,
+                 controller=None, initializer=None, prefetcher=None):
+        """Initializes the pool with given number of processes, or of threads in
+        this process if threaded is True. Threads suit tasks that mostly wait on
+        the network, since their results don't have to be pickled. If a
+        BackgroundScheduler is given, tasks are picked from its rankings
+        instead of prioritizing on the calling thread. If budget_seconds is
+        given, tasks must all be DownloadTasks, and free processes are filled
+        with the tasks worth the most priority that fit in a budget of
+        budget_seconds worth of bytes in flight at the measured throughput,
+        instead of with the best tasks per byte. If a ConcurrencyController is
+        given, num_procs is adjusted by the controller as it runs, and workers
+        are added as it grows. initializer is called in each
+        worker when it starts. If a katasked.task.prefetch.Prefetcher is given,
+        slots left idle because nothing is queued are filled with its tasks."""
         self.num_procs = num_procs
         self.type_name = type_name
-        self.pool = multiprocessing.Pool(self.num_procs)
-        self.to_run = set()
+        self.scheduler = scheduler
+        self.budget_seconds = budget_seconds
+        self.throughput = ThroughputMeter(self.INITIAL_THROUGHPUT)
+        self.bytes_running = 0
+        self.controller = controller
+        self.prefetcher = prefetcher
+        self.threaded = threaded
+        self.num_workers = num_procs
+        self.pool = self._start_workers(num_procs, initializer)
+        self.first_task_seconds = []
+        """How long the first task of each worker took, see _call_catching"""
+        self.to_run = IndexedHeap()
+        self.unscored = set()
+        """Queued tasks whose priority in to_run may be out of date, see _update_priorities"""
+        self.scored_poses = None
+        """Camera poses everything in to_run was last scored at"""
+        self.last_poses = None
+        """Camera poses of the last poll that picked tasks, see _take_best"""
+        self.task_table = None
+        """A priority.TaskTable of to_run, made the first time _take_best needs it"""
         self.task_slug_map = collections.defaultdict(set)
-        self.running = []
+        # completion key -> TaskResult
+        self.running = {}
+        self.held_types = ()
+        """Task types that stay queued instead of being started, see MultiplexPool.hold"""
+        self.set_aside = []
+        self.dispatched = []
+        """Tasks started by the last poll"""
+        self.completed = Queue.Queue()
+        self.completion_keys = itertools.count()
         self.sequence_num = 0
         self.sequence_map = {}
-        self.last_action = time.time()
+        self.last_action = self.clock()
 
     def add_task(self, task):
         """Add a task to the pool"""
         task.pool = self
         self.task_slug_map[task.modelslug].add(task)
-        self.to_run.add(task)
+        self._push(task)
+        self.unscored.add(task)
+        trace.record(trace.ENQUEUE, task, self.type_name)
         
-    def apply_async(self, *args, **kwargs):
-        return self.pool.apply_async(*args, **kwargs)
+    def apply_async(self, func, args=(), kwds={}):
+        """Runs func in the pool. Once it's done, the key attribute of the
+        returned AsyncResult is put on the completed queue from the pool's
+        result thread, so finished tasks don't wait to be noticed."""
+        key = next(self.completion_keys)
+        callback = lambda value: self.completed.put((key, self.clock()))
+        async_result = self.pool.apply_async(_call_catching, [func, args, kwds], callback=callback)
+        async_result.key = key
+        return async_result
 
     def get_tasks_by_slug(self, slug):
         return self.task_slug_map[slug]
 
+    def mark_stale(self, slugs):
+        """Has the queued tasks of slugs rescored, for when their perceptual
+        error changed"""
+        for slug in slugs:
+            stale = [task for task in self.task_slug_map.get(slug, ()) if task in self.to_run]
+            self.unscored.update(stale)
+            if self.task_table is not None:
+                for task in stale:
+                    self.task_table.update(task)
+    
+    def hold(self, task_types):
+        """Keeps queued tasks that are instances of any of task_types from
+        being started, see MultiplexPool.hold"""
+        self.held_types = tuple(task_types)
+        if self.task_table is not None:
+            self.task_table.set_held(self.held_types)
+
+    def cancel(self, task):
+        """Removes a queued task from the queue. Running tasks can't be
+        cancelled, since finishing a texture or refinement task is what queues
+        the next one of its model. Returns False if the task isn't queued."""
+        if task not in self.to_run:
+            return False
+        
+        self._remove(task)
+        self.unscored.discard(task)
+        self.task_slug_map[task.modelslug].discard(task)
+        trace.record(trace.CANCEL, task, self.type_name)
+        return True
+
+    def has_completed(self):
+        """Returns True if a running task has finished since the last poll"""
+        return not self.completed.empty()
+    
     def _check_waiting(self):
-        """Checks list of running tasks for any that have finished"""
+        """Removes and returns the running tasks that have finished"""
         finished = []
-        new_running = []
-        for runningtask in self.running:
-            if runningtask.result.ready():
-                finished.append(runningtask)
-            else:
-                new_running.append(runningtask)
-        self.running = new_running
+        while True:
+            try:
+                key, finish_time = self.completed.get_nowait()
+            except Queue.Empty:
+                break
+            runningtask = self.running.pop(key)
+            finished.append(runningtask)
+            trace.record(trace.COMPLETE, runningtask.task, self.type_name, running=len(self.running))
+            
+            if self.controller is not None:
+                self.controller.record(runningtask.task.download_size, finish_time - runningtask.started)
         return finished
+    
+    def _iter_ranked(self):
+        """Removes queued tasks best first, yielding each with its priority in
+        to_run. With a scheduler, tasks are taken in the order of its latest
+        ranking and yielded with the priority it gave them, and tasks queued
+        since that ranking was made are only taken once every ranked task has
+        been. Tasks of held_types are skipped, and
+        the ones removed from to_run to get past them are kept in set_aside
+        until _restore_set_aside is called."""
+        if self.scheduler is not None:
+            for task, task_priority in self.scheduler.get_ranking(self.type_name) or []:
+                if task in self.to_run and not isinstance(task, self.held_types):
+                    self._remove(task)
+                    yield task, task_priority
+        
+        while len(self.to_run) > 0:
+            task = self.to_run.heap[0]
+            task_priority = self.to_run.get_priority(task)
+            self._remove(task)
+            if isinstance(task, self.held_types):
+                self.set_aside.append((task, task_priority))
+                continue
+            yield task, task_priority
+    
+    def _update_priorities(self, pandastate, poses, reprioritize=True):
+        """Brings the priorities in to_run up to date for the camera at poses.
+        Everything is rescored once the camera has moved further than the
+        metrics cache allows since the last time it was, and otherwise only the
+        tasks in unscored. If reprioritize is False, only the tasks in unscored
+        are, however far the camera moved."""
+        if reprioritize and (self.scored_poses is None or priority.poses_moved(self.scored_poses, poses)):
+            tasks = list(self.to_run)
+            self.scored_poses = poses
+        else:
+            tasks = [task for task in self.unscored if task in self.to_run]
+        self.unscored.clear()
+        
+        if len(tasks) > 0:
+            priority.update_priorities(pandastate, self.to_run, tasks, poses)
+    
+    def _push(self, task, task_priority=0.0):
+        """Queues task in to_run and the task table"""
+        self.to_run.push(task, task_priority)
+        if self.task_table is not None:
+            self.task_table.add(task)
+    
+    def _remove(self, task):
+        """Removes a queued task from to_run and the task table"""
+        self.to_run.remove(task)
+        if self.task_table is not None:
+            self.task_table.remove(task)
+    
+    def _restore_set_aside(self):
+        for task, task_priority in self.set_aside:
+            self._push(task, task_priority)
+        self.set_aside = []
+    
+    def _take_ranked(self, N):
+        """Removes and returns the N best tasks as (task, priority) pairs"""
+        return list(itertools.islice(self._iter_ranked(), N))
+    
+    def _take_best(self, pandastate, N, reprioritize=True):
+        """Removes and returns the N best tasks as (task, priority) pairs. While
+        the camera moves the whole queue would be rescored on every poll, so the
+        best are found with priority.calc_table_highest_N instead, which skips
+        the parts of the scene that can't hold them. It searches task_table,
+        which is kept up to date as tasks are queued and taken, so a poll does
+        array operations over the queue but no Python per queued task. The
+        priorities in to_run are then out of date until the camera stops and
+        they are rescored. If reprioritize is False, tasks are taken from
+        to_run as it is, after scoring the ones in unscored."""
+        if self.scheduler is not None:
+            return self._take_ranked(N)
+        
+        poses = priority.get_camera_poses(pandastate)
+        moving = reprioritize and self.last_poses is not None and priority.poses_moved(self.last_poses, poses)
+        if reprioritize:
+            self.last_poses = poses
+        if not moving:
+            self._update_priorities(pandastate, poses, reprioritize)
+            return self._take_ranked(N)
+        
+        if self.task_table is None:
+            self.task_table = priority.TaskTable(pandastate.instance_bounds)
+            self.task_table.set_held(self.held_types)
+            for task in self.to_run:
+                self.task_table.add(task)
+        
+        chosen = priority.calc_table_highest_N(pandastate, self.task_table, N, poses)
+        for task, task_priority in chosen:
+            self._remove(task)
+        return chosen
+    
+    def _take_budgeted(self, pandastate, budget, max_tasks, reprioritize=True):
+        """Removes and returns, as (task, priority) pairs, up to max_tasks tasks
+        whose download sizes add up to at most budget bytes, picked to maximize
+        their total priority. The BUDGET_LOOKAHEAD best tasks are considered.
+        They are ranked by priority per byte, so taking them greedily in order
+        and skipping those that don't fit packs the budget well. If the single
+        most valuable task that fits is worth more than the greedy set it's
+        taken alone instead. When nothing is running,
+        the best task is taken even if it doesn't fit, so large downloads can't
+        starve. reprioritize is passed to _take_best."""
+        chosen = []
+        skipped = []
+        remaining = budget
+        best_single = None
+        
+        for task, task_priority in self._take_best(pandastate, self.BUDGET_LOOKAHEAD, reprioritize):
+            value = task_priority * task.download_size
+            if task.download_size <= budget and (best_single is None or value > best_single[2]):
+                best_single = (task, task_priority, value)
+            
+            if len(chosen) < max_tasks and task.download_size <= remaining:
+                chosen.append((task, task_priority, value))
+                remaining -= task.download_size
+            else:
+                skipped.append((task, task_priority))
+        
+        if best_single is not None and best_single not in chosen and \
+                best_single[2] > sum(value for task, task_priority, value in chosen):
+            skipped.extend((task, task_priority) for task, task_priority, value in chosen)
+            skipped.remove(best_single[:2])
+            chosen = [best_single]
+        
+        chosen = [(task, task_priority) for task, task_priority, value in chosen]
+        if len(chosen) == 0 and len(self.running) == 0 and len(skipped) > 0:
+            chosen.append(skipped.pop(0))
+        
+        for task, task_priority in skipped:
+            self._push(task, task_priority)
+        
+        return chosen
 
     def empty(self):
         """Returns True if the pool is empty"""
         return len(self.to_run) + len(self.running) == 0
 
-    def poll(self, pandastate):
-        """Executes tasks and gets results. Should be executed often."""
+    def poll(self, pandastate, reprioritize=True):
+        """Executes tasks and gets results. Should be executed often. If
+        reprioritize is False, free slots are filled without rescoring the
+        queue, see _take_best."""
+        was_busy = len(self.running) > 0
         finished_running = self._check_waiting()
+        self.dispatched = []
 
-        now = time.time()
-        if now - self.last_action > 5:
+        now = self.clock()
+        if self.controller is not None:
+            saturated = len(self.to_run) > 0 and len(self.running) + len(finished_running) >= self.num_procs
+            self.num_procs = self.controller.update(now, saturated)
+            if self.num_procs > self.num_workers:
+                self._add_workers(self.num_procs)
+        if now - self.last_action > 5 and self.LOG_TASKS:
             self.last_action = now
             print 'Waiting on', len(self.running), 'tasks to complete', len(self.to_run), 'queued.'
         
         to_return = []
         for runningtask in finished_running:
-            self.task_slug_map[runningtask.task.modelslug].remove(runningtask.task)
+            # prefetch tasks are never queued, so they aren't in the map
+            self.task_slug_map[runningtask.task.modelslug].discard(runningtask.task)
         for runningtask in finished_running:
-            res = runningtask.result.get()
+            ex, res, first_seconds = runningtask.result.get()
+            if first_seconds is not None:
+                self.first_task_seconds.append(first_seconds)
+                print 'First task of a %s worker took %.3f seconds' % (self.type_name, first_seconds)
+            if ex is not None:
+                raise ex
             runningtask.task.finished(res)
             to_return.append(runningtask.task)
+        # finishing a task changes the perceptual error of the other tasks of its model
+        self.mark_stale(set(task.modelslug for task in to_return))
 
+        if self.budget_seconds is not None:
+            completed_bytes = sum(runningtask.task.download_size for runningtask in finished_running)
+            self.bytes_running -= completed_bytes
+            self.throughput.update(now, was_busy, completed_bytes)
+        
         if len(self.running) >= self.num_procs:
             return to_return
 
         num_to_run = min(self.num_procs - len(self.running), len(self.to_run))
-        if num_to_run < 1:
+        if num_to_run < 1 and self.prefetcher is None:
             return to_return
         
-        largestN = priority.get_highest_N(pandastate, self.to_run, num_to_run)
+        if num_to_run < 1:
+            chosen = []
+        elif self.budget_seconds is not None:
+            budget = self.throughput.rate * self.budget_seconds - self.bytes_running
+            if budget <= 0 and len(self.running) > 0:
+                return to_return
+            chosen = self._take_budgeted(pandastate, budget, num_to_run, reprioritize)
+        else:
+            chosen = self._take_best(pandastate, num_to_run, reprioritize)
+        self._restore_set_aside()
+        largestN = [task for task, task_priority in chosen]
+        # prefetch tasks have no priority in to_run
+        dispatch_priorities = dict(chosen)
+        
+        if self.prefetcher is not None:
+            for task in largestN:
+                self.prefetcher.claim(task)
+            
+            idle = self.num_procs - len(self.running) - len(largestN)
+            if idle > 0 and len(self.to_run) == 0:
+                for task in self.prefetcher.take(pandastate, idle):
+                    task.pool = self
+                    largestN.append(task)
+            
+            if len(largestN) == 0:
+                return to_return
+        
+        if self.budget_seconds is not None:
+            self.bytes_running += sum(task.download_size for task in largestN)
         
         self.last_action = now
         
         for task in largestN:
             self.sequence_map[task] = self.sequence_num
-            print "==(%d)==>" % self.sequence_num, task
+            if self.LOG_TASKS:
+                print "==(%d)==>" % self.sequence_num, task
             self.sequence_num += 1
             
-            self.to_run.remove(task)
-            self.running.append(result.TaskResult(task=task, result=task.run()))
+            self._start_task(task, now)
+            trace.record(trace.DISPATCH, task, self.type_name, dispatch_priorities.get(task), len(self.running))
+        self.dispatched = largestN
         
         for outtask in to_return:
-            print "<==(%d)==" % self.sequence_map[outtask], outtask
+            if self.LOG_TASKS:
+                print "<==(%d)==" % self.sequence_map[outtask], outtask
             del self.sequence_map[outtask]
         
         return to_return
+    
+    def _start_workers(self, num_workers, initializer):
+        """Returns the worker pool tasks are run in"""
+        if self.threaded:
+            return multiprocessing.pool.ThreadPool(num_workers, initializer)
+        return multiprocessing.Pool(num_workers, initializer)
+    
+    def _add_workers(self, num_workers):
+        """Grows the worker pool to num_workers workers"""
+        # Pool has no public way to grow. _repopulate_pool starts workers up to
+        # _processes, and is how the pool itself replaces workers that exit.
+        self.pool._processes = num_workers
+        self.pool._repopulate_pool()
+        self.num_workers = num_workers
+    
+    def _start_task(self, task, now):
+        """Starts a task and adds it to running"""
+        async_result = task.run()
+        self.running[async_result.key] = result.TaskResult(task=task, result=async_result, started=now)
 
 class MultiplexPool(object):
     """A task pool that multiplexes tasks across multiple TaskPool objects"""
     
-    POOL_TYPES = [taskbase.DownloadTask, taskbase.LoadTask]
+    POOL_TYPES = [taskbase.DownloadTask, taskbase.LoadTask, taskbase.PipelineTask]
     NUM_PROCS = {taskbase.DownloadTask: 4,
-                 taskbase.LoadTask: multiprocessing.cpu_count()}
+                 taskbase.LoadTask: multiprocessing.cpu_count(),
+                 taskbase.PipelineTask: multiprocessing.cpu_count() + 4}
+    THREADED = {taskbase.DownloadTask: False,
+                taskbase.LoadTask: False,
+                taskbase.PipelineTask: False}
+    """Pool types whose NUM_PROCS workers are threads of this process instead of processes"""
+    INITIALIZERS = {taskbase.LoadTask: open3dhub.warm_up,
+                    taskbase.PipelineTask: open3dhub.warm_up}
+    """Functions called in each worker of a pool type when it starts"""
+    MAX_PROCS = {taskbase.DownloadTask: 32,
+                 taskbase.PipelineTask: 2 * multiprocessing.cpu_count() + 8}
+    """Upper bound of the number of tasks each pool type runs at once with
+    adaptive concurrency. Load tasks are CPU bound and already run one per
+    core, so their pool isn't adaptive."""
+    DEFERRABLE = (texturetask.TextureDownloadTask, refinementtask.MeshRefinementDownloadTask)
+    """Task types that can wait while their model is out of view"""
+    UNTHREADED = (texturetask.TextureDownloadTask,)
+    """Download task types that get a pool of worker processes of their own when
+    downloads run on threads. Texture tasks decode the image and write a BAM
+    with Panda3D, which isn't safe off the main thread and would hold the GIL
+    from the render loop."""
     
-    def __init__(self):
+    def __init__(self, background_priority=False, download_budget=None, download_threads=None, pipeline=False,
+                 adaptive_concurrency=False, prefetch=False, prefetch_ahead=1, defer_hidden=False):
+        """If download_budget is given, the download pool fills its free
+        processes with the tasks worth the most priority that fit in a byte
+        budget of that many seconds at its measured throughput. If
+        download_threads is given, downloads run on that many threads instead of
+        on worker processes, except for the UNTHREADED types, which keep
+        NUM_PROCS processes. Refinement tasks still parse their chunk on the
+        download thread, in pure Python, holding the GIL from the render loop
+        while they do. If pipeline is True, base meshes are downloaded and
+        loaded by a single MeshPipelineTask, see katasked.task.mesh. If
+        adaptive_concurrency is True, each pool type in MAX_PROCS starts at
+        NUM_PROCS tasks at once and a ConcurrencyController moves that between
+        1 and MAX_PROCS. If prefetch
+        is True, idle download slots prefetch the next stages of the highest
+        priority models, up to prefetch_ahead stages ahead of their real tasks,
+        see katasked.task.prefetch. If defer_hidden is True,
+        queued DEFERRABLE tasks of models that are out of view now and at every
+        predicted camera pose are cancelled, and queued again once their model
+        comes into view."""
+        self.pipeline = pipeline
+        self.deferred = collections.defaultdict(list) if defer_hidden else None
+        """Tasks cancelled by defer_hidden, by slug"""
+        self.prefetcher = prefetchtask.Prefetcher(max_ahead=prefetch_ahead) if prefetch else None
+        self.scheduler = None
+        if background_priority:
+            self.scheduler = scheduler.BackgroundScheduler()
+        
+        # before the pools start, so all their workers share the spool
+        spool.init_spool()
+        
+        num_procs = dict(self.NUM_PROCS)
+        max_procs = dict(self.MAX_PROCS)
+        threaded = dict(self.THREADED)
+        self.pool_types = list(self.POOL_TYPES)
+        """Types of the pools, a task goes to the first one it's an instance of"""
+        if download_threads is not None:
+            for pool_type in self.UNTHREADED:
+                self.pool_types.insert(0, pool_type)
+                num_procs[pool_type] = num_procs[taskbase.DownloadTask]
+                max_procs[pool_type] = max_procs[taskbase.DownloadTask]
+                threaded[pool_type] = False
+            num_procs[taskbase.DownloadTask] = download_threads
+            max_procs[taskbase.DownloadTask] = max(download_threads, max_procs[taskbase.DownloadTask])
+            threaded[taskbase.DownloadTask] = True
+        if not pipeline:
+            self.pool_types.remove(taskbase.PipelineTask)
+        
         self.pools = {}
-        for pool_type in self.POOL_TYPES:
-            self.pools[pool_type] = TaskPool(self.NUM_PROCS[pool_type], type_name="%s" % str(pool_type))
+        for pool_type in self.pool_types:
+            budget_seconds = download_budget if issubclass(pool_type, taskbase.DownloadTask) else None
+            controller = None
+            if adaptive_concurrency and pool_type in max_procs:
+                controller = ConcurrencyController(num_procs[pool_type], 1, max_procs[pool_type])
+            self.pools[pool_type] = self._make_pool(num_procs[pool_type],
+                                                    type_name="%s" % str(pool_type),
+                                                    scheduler=self.scheduler,
+                                                    budget_seconds=budget_seconds,
+                                                    threaded=threaded[pool_type],
+                                                    controller=controller,
+                                                    initializer=self.INITIALIZERS.get(pool_type),
+                                                    prefetcher=self.prefetcher if pool_type is taskbase.DownloadTask else None)
+    
+    def _make_pool(self, num_procs, **kwargs):
+        return TaskPool(num_procs, **kwargs)
     
     def add_task(self, task):
-        for pool_type in self.POOL_TYPES:
+        for pool_type in self.pool_types:
             if isinstance(task, pool_type):
                 task.multiplexer = self
                 self.pools[pool_type].add_task(task)
@@ -115,16 +744,78 @@ class MultiplexPool(object):
         tasks = []
         for pool in self.pools.itervalues():
             tasks.extend(pool.get_tasks_by_slug(slug))
+        if self.deferred is not None:
+            tasks.extend(self.deferred.get(slug, []))
         return tasks
 
-    def empty(self):
+    def cancel(self, task):
+        """Removes a queued task from its pool's queue, see TaskPool.cancel"""
+        for pool_type in self.pool_types:
+            if isinstance(task, pool_type):
+                return self.pools[pool_type].cancel(task)
+        return False
+
+    def hold(self, task_types):
+        """Keeps queued tasks that are instances of any of task_types from being
+        started, until hold is called again without them. Running tasks
+        aren't affected."""
+        for pool in self.pools.itervalues():
+            pool.hold(task_types)
+
+    def defer_hidden(self, pandastate):
+        """Queues the deferred tasks of models that came into view, and defers
+        the queued DEFERRABLE tasks of models that went out of view"""
+        visible = priority.calc_visible_slugs(pandastate)
+        
+        for slug in [slug for slug in self.deferred if slug in visible]:
+            for task in self.deferred.pop(slug):
+                self.add_task(task)
+        
+        for pool in self.pools.itervalues():
+            for task in [task for task in pool.to_run if isinstance(task, self.DEFERRABLE)]:
+                if task.modelslug not in visible:
+                    pool.cancel(task)
+                    self.deferred[task.modelslug].append(task)
+
+    def has_completed(self):
+        """Returns True if any pool has finished tasks waiting to be polled"""
+        return any(pool.has_completed() for pool in self.pools.itervalues())
+    
+    def empty(self, include_deferred=True):
+        """Returns True if no pool has queued or running tasks and, unless
+        include_deferred is False, no tasks are deferred by defer_hidden.
+        Deferred tasks only run once their model comes into view, so they
+        don't keep loading from having finished."""
         for pool in self.pools.itervalues():
             if not pool.empty():
                 return False
-        return True
+        return not (include_deferred and self.deferred)
 
-    def poll(self, pandastate):
+    def poll(self, pandastate, reprioritize=True):
+        """Polls every pool, returning the tasks that finished. If reprioritize
+        is False, finished tasks are collected and free slots refilled, but
+        the queues aren't rescored, hidden models aren't deferred and nothing
+        is submitted to the scheduler."""
+        if self.deferred is not None and reprioritize:
+            self.defer_hidden(pandastate)
+        
         finished = []
-        for pool in self.pools.itervalues():
-            finished.extend(pool.poll(pandastate))
+        # the pool that prefetches goes last, so the stages the other pools
+        # just started are claimed before it picks what to prefetch
+        for pool in sorted(self.pools.itervalues(), key=lambda pool: pool.prefetcher is not None):
+            pool_finished = pool.poll(pandastate, reprioritize)
+            if self.prefetcher is not None and pool.prefetcher is None:
+                for task in pool.dispatched:
+                    self.prefetcher.claim(task)
+            slugs = set(task.modelslug for task in pool_finished)
+            for other in self.pools.itervalues():
+                if other is not pool:
+                    other.mark_stale(slugs)
+            finished.extend(pool_finished)
+        
+        if self.scheduler is not None and reprioritize:
+            # the camera is only read here, on the main thread
+            queues = dict((pool.type_name, list(pool.to_run)) for pool in self.pools.itervalues())
+            self.scheduler.submit(pandastate, priority.get_camera_poses(pandastate), queues)
+        
         return finished
@@ -0,0 +1,255 @@
+import collections
+import traceback
+
+import katasked.task.base as base
+import katasked.task.mesh as meshtask
+import katasked.task.texture as texturetask
+import katasked.task.refinement as refinementtask
+import katasked.task.priority as priority
+import katasked.open3dhub as open3dhub
+import meshtool.filters.print_filters.print_pm_perceptual_error as percepfilter
+
+Stage = collections.namedtuple('Stage', ['key', 'fetches', 'size'])
+"""A download of a model's progressive chain. key identifies the task that
+downloads it, fetches is a list of (hash, httprange) and size is the number of
+bytes downloaded."""
+
+def build_chains(metadata):
+    """Returns the stages of a model after its metadata as a list of chains, each
+    a list of stages that depend on the one before. The base mesh comes first,
+    followed by the texture levels and the mesh refinements, which both depend
+    on the base mesh."""
+    progressive = metadata['metadata']['types']['progressive']
+    mesh_hash, atlas_hash, base_level = meshtask.base_hashes(progressive)
+    base_stage = Stage(('mesh',),
+                       [(mesh_hash, None), (atlas_hash, (base_level['offset'], base_level['length']))],
+                       progressive['size_gzip'])
+    
+    texture_chain = []
+    for levelinfo in progressive['mipmaps']['./atlas.jpg']['byte_ranges']:
+        if levelinfo['offset'] > base_level['offset']:
+            texture_chain.append(Stage(('texture', levelinfo['offset']),
+                                       [(atlas_hash, (levelinfo['offset'], levelinfo['length']))],
+                                       levelinfo['length']))
+    
+    refinement_chain = []
+    if progressive['progressive_stream'] is not None:
+        stream_size = progressive['progressive_stream_size']
+        for offset in range(0, stream_size, percepfilter.PM_CHUNK_SIZE):
+            length = min(stream_size - offset, percepfilter.PM_CHUNK_SIZE)
+            refinement_chain.append(Stage(('refinement', offset),
+                                          [(progressive['progressive_stream'], (offset, length))],
+                                          length))
+    
+    return [[base_stage]] + [[base_stage] + chain for chain in (texture_chain, refinement_chain) if len(chain) > 0]
+
+def stage_key(task):
+    """Returns the key of the stage a real task downloads, or None"""
+    if isinstance(task, (meshtask.MeshDownloadTask, meshtask.MeshPipelineTask)):
+        return ('mesh',)
+    elif isinstance(task, texturetask.TextureDownloadTask):
+        return ('texture', task.levelinfo['offset'])
+    elif isinstance(task, refinementtask.MeshRefinementDownloadTask):
+        return ('refinement', task.offset)
+    return None
+
+def _follows(before, after):
+    """Whether the fetch after is of a range of the same hash that starts inside
+    or right at the end of the range of the fetch before"""
+    (before_hash, before_range), (after_hash, after_range) = before, after
+    if before_hash != after_hash or before_range is None or after_range is None:
+        return False
+    return before_range[0] <= after_range[0] <= before_range[0] + before_range[1]
+
+def _joins(stage, following):
+    """Whether following can be fetched with the last request of stage"""
+    return len(following.fetches) == 1 and _follows(stage.fetches[-1], following.fetches[0])
+
+def _coalesce(fetches):
+    """Groups consecutive fetches of touching ranges of the same hash, returning
+    a list of (hash, [httprange])"""
+    groups = []
+    for fetch in fetches:
+        if len(groups) > 0 and _follows((groups[-1][0], groups[-1][1][-1]), fetch):
+            groups[-1][1].append(fetch[1])
+        else:
+            groups.append((fetch[0], [fetch[1]]))
+    return groups
+
+def _run(fetches):
+    # a failed prefetch only means the real task has to download it, so it
+    # returns False instead of raising
+    try:
+        for dlhash, httpranges in _coalesce(fetches):
+            if len(httpranges) == 1:
+                open3dhub.hashfetch(dlhash, httprange=httpranges[0])
+            else:
+                open3dhub.prefetch_ranges(dlhash, httpranges)
+    except Exception:
+        traceback.print_exc()
+        return False
+    return True
+
+class PrefetchTask(base.DownloadTask):
+    """Downloads stages of a model's chain into the cache before the tasks that
+    need them exist. Stages whose ranges follow on from each other are
+    downloaded with one request."""
+    
+    def __init__(self, modelslug, stage, perceptual_error, prefetcher):
+        super(PrefetchTask, self).__init__(modelslug)
+        self.stages = [stage]
+        self.download_size = stage.size
+        self.perceptual_error = perceptual_error
+        self.prefetcher = prefetcher
+    
+    def add_stage(self, stage):
+        """Adds a stage that follows the last one in its chain"""
+        self.stages.append(stage)
+        self.download_size += stage.size
+    
+    def run(self):
+        return self.pool.apply_async(_run, [[fetch for stage in self.stages for fetch in stage.fetches]])
+    
+    def _update_loaded_already(self, loaded_already):
+        pass
+    
+    def finished(self, result):
+        self.prefetcher.prefetched(self, result)
+    
+    def __str__(self):
+        return '<PrefetchTask %s %s>' % (self.modelslug, ' '.join(str(stage.key) for stage in self.stages))
+    def __repr__(self):
+        return str(self)
+
+class Prefetcher(object):
+    """Keeps the progressive chains of every model whose metadata has arrived,
+    and hands out PrefetchTasks for the next stages of the highest priority
+    models to fill download slots that would otherwise be idle. Keeps count of
+    how many prefetched bytes the real tasks ended up using."""
+    
+    PENDING, PREFETCHED, CLAIMED = range(3)
+    
+    def __init__(self, max_ahead=1, max_unclaimed_bytes=16 * 1024 * 1024):
+        """max_ahead is how many stages a chain can be prefetched ahead of its
+        real tasks, and max_unclaimed_bytes is the most bytes that can be
+        prefetched without a real task having claimed them yet. With max_ahead
+        above 1, a prefetch task takes as many consecutive stages of a chain as
+        it can fetch with one ranged request."""
+        self.max_ahead = max_ahead
+        self.max_unclaimed_bytes = max_unclaimed_bytes
+        self.chains = {}
+        self.perceptual_errors = {}
+        self.states = {}
+        self.unclaimed_bytes = 0
+        
+        self.prefetched_bytes = 0
+        """Bytes downloaded by prefetch tasks"""
+        self.used_bytes = 0
+        """Prefetched bytes that a real task then found in the cache"""
+        self.duplicate_bytes = 0
+        """Prefetched bytes that a real task downloaded again because the prefetch hadn't finished"""
+    
+    def add_model(self, modelslug, metadata):
+        """Builds the chains of a model once its metadata is known"""
+        progressive = metadata['metadata']['types']['progressive']
+        self.chains[modelslug] = build_chains(metadata)
+        self.perceptual_errors[modelslug] = progressive['progressive_perceptual_error'][0]['pixel_error']
+    
+    def claim(self, task):
+        """Called when a real task starts, so its stage isn't prefetched anymore"""
+        key = stage_key(task)
+        if key is None or task.modelslug not in self.chains:
+            return
+        
+        state_key = (task.modelslug, key)
+        state = self.states.get(state_key)
+        self.states[state_key] = self.CLAIMED
+        if state == self.PENDING:
+            self.duplicate_bytes += self._stage(task.modelslug, key).size
+        elif state == self.PREFETCHED:
+            size = self._stage(task.modelslug, key).size
+            self.used_bytes += size
+            self.unclaimed_bytes -= size
+    
+    def prefetched(self, task, succeeded):
+        """Called when a PrefetchTask finishes"""
+        for stage in task.stages:
+            state_key = (task.modelslug, stage.key)
+            pending = self.states.get(state_key) == self.PENDING
+            if not succeeded:
+                # left for the real task to download
+                if pending:
+                    self.states[state_key] = self.CLAIMED
+                self.unclaimed_bytes -= stage.size
+                continue
+            
+            self.prefetched_bytes += stage.size
+            if pending:
+                self.states[state_key] = self.PREFETCHED
+            else:
+                # a real task claimed it while it was downloading
+                self.unclaimed_bytes -= stage.size
+    
+    def take(self, pandastate, N):
+        """Returns up to N PrefetchTasks for the next stages of the highest
+        priority models, within the prefetch limits"""
+        candidates = []
+        following = {}
+        for modelslug, chains in self.chains.iteritems():
+            stages = self._next_stages(modelslug, chains)
+            if len(stages) > 0:
+                # ranked by the first stage, so joining stages doesn't lower the priority per byte
+                task = PrefetchTask(modelslug, stages[0], self.perceptual_errors[modelslug], self)
+                following[task] = stages[1:]
+                candidates.append(task)
+        
+        chosen = []
+        for task in priority.rank_tasks(pandastate, candidates):
+            if len(chosen) == N or self.unclaimed_bytes + task.download_size > self.max_unclaimed_bytes:
+                break
+            self.states[(task.modelslug, task.stages[0].key)] = self.PENDING
+            self.unclaimed_bytes += task.download_size
+            for stage in following[task]:
+                if self.unclaimed_bytes + stage.size > self.max_unclaimed_bytes:
+                    break
+                self.states[(task.modelslug, stage.key)] = self.PENDING
+                self.unclaimed_bytes += stage.size
+                task.add_stage(stage)
+            chosen.append(task)
+        
+        return chosen
+    
+    def summary(self):
+        wasted = self.prefetched_bytes - self.used_bytes
+        return 'Prefetched %d bytes, %d used, %d downloaded twice, %d wasted' % \
+               (self.prefetched_bytes, self.used_bytes, self.duplicate_bytes, wasted)
+    
+    def _stage(self, modelslug, key):
+        for chain in self.chains[modelslug]:
+            for stage in chain:
+                if stage.key == key:
+                    return stage
+    
+    def _next_stages(self, modelslug, chains):
+        """First stage of any chain that hasn't been claimed or prefetched, if
+        the chain isn't already max_ahead stages ahead of its real tasks,
+        followed by the stages after it that join its request, up to max_ahead
+        stages ahead. Returns an empty list if there is none."""
+        for chain in chains:
+            ahead = 0
+            for i, stage in enumerate(chain):
+                state = self.states.get((modelslug, stage.key))
+                if state == self.CLAIMED:
+                    ahead = 0
+                elif state is not None:
+                    ahead += 1
+                elif ahead < self.max_ahead:
+                    stages = [stage]
+                    for following in chain[i + 1:i + self.max_ahead - ahead]:
+                        if (modelslug, following.key) in self.states or not _joins(stages[-1], following):
+                            break
+                        stages.append(following)
+                    return stages
+                else:
+                    break
+        return []
@@ -1,3 +1,3 @@
 import os
 
-from cython_impl import *
+from numpy_impl import *
@@ -0,0 +1,777 @@
+import math
+import heapq
+import json
+import operator
+import random
+
+import numpy
+import panda3d.core as p3d
+
+import katasked.task.base as taskbase
+import katasked.prediction as prediction
+
+MAX_SOLID_ANGLE = 4.0 * math.pi
+
+# seconds ahead of the current time to predict the camera for
+HORIZONS = [2.0, 5.0]
+
+def _metric_names(horizons):
+    futures = [prediction.horizon_name(h) for h in horizons]
+    return ['solid_angle'] + \
+           ['%s_solid_angle' % f for f in futures] + \
+           ['camera_angle', 'camera_angle_exp'] + \
+           ['%s_camera_angle' % f for f in futures] + \
+           ['perceptual_error',
+            'perceptual_error_scale',
+            'perceptual_error_sang',
+            'perceptual_error_exp',
+            'perceptual_error_exp_scale',
+            'perceptual_error_exp_sang',
+            'distance',
+            'scale']
+
+METRIC_NAMES = _metric_names(HORIZONS)
+"""Column order of the metrics matrix passed to PriorityAlgorithm.combine_batch"""
+
+METRIC_COLUMNS = dict((name, i) for i, name in enumerate(METRIC_NAMES))
+
+def _check_metrics(algorithm, metric_names, horizons):
+    """Raises ValueError if algorithm uses metrics that aren't in metric_names"""
+    missing = [name for name in algorithm.metrics_used() if name not in metric_names]
+    if len(missing) > 0:
+        raise ValueError('Priority algorithm %s uses %s, which prediction horizons of %s seconds do not provide' %
+                         (type(algorithm).__name__, ', '.join(sorted(missing)), ', '.join('%g' % h for h in horizons)))
+
+def set_prediction_horizons(horizons):
+    """Sets the horizons, in seconds, that the camera is predicted for. Each one
+    adds future_<horizon>_solid_angle and future_<horizon>_camera_angle metrics.
+    Raises ValueError if the selected algorithm uses a horizon left out."""
+    _check_metrics(SELECTED_ALGORITHM, _metric_names(horizons), horizons)
+    HORIZONS[:] = horizons
+    METRIC_NAMES[:] = _metric_names(horizons)
+    METRIC_COLUMNS.clear()
+    METRIC_COLUMNS.update((name, i) for i, name in enumerate(METRIC_NAMES))
+
+class PriorityAlgorithm(object):
+    # True if combine never decreases when a metric increases, which lets
+    # calc_highest_N skip tasks whose upper bound can't reach the top N
+    monotonic = False
+    
+    def metrics_used(self):
+        """Names of the metrics the algorithm combines"""
+        return []
+    
+    def combine(self, metrics):
+        raise NotImplementedError()
+    
+    def combine_batch(self, matrix):
+        """Combines a matrix of metrics, one row per object and one column per
+        entry of METRIC_NAMES, into a vector of priorities. Falls back to calling
+        combine for each row, subclasses should override it with array operations."""
+        combined = numpy.empty(len(matrix))
+        for row in range(len(matrix)):
+            metrics = Metrics()
+            for name, value in zip(METRIC_NAMES, matrix[row]):
+                setattr(metrics, name, value)
+            combined[row] = self.combine(metrics)
+        return combined
+
+class LinearAlgorithm(PriorityAlgorithm):
+    """Weighted sum of metrics, with weights given as a dict of metric name to weight"""
+    weights = {}
+    
+    monotonic = property(lambda s: all(w >= 0 for w in s.weights.itervalues()))
+    
+    def metrics_used(self):
+        return self.weights.keys()
+    
+    def _get_weight_vector(self):
+        vector = numpy.zeros(len(METRIC_NAMES))
+        for name, weight in self.weights.iteritems():
+            vector[METRIC_COLUMNS[name]] = weight
+        return vector
+    
+    weight_vector = property(_get_weight_vector)
+    
+    def combine(self, metrics):
+        return sum(getattr(metrics, name) * weight for name, weight in self.weights.iteritems())
+    
+    def combine_batch(self, matrix):
+        return matrix.dot(self.weight_vector)
+
+class ProductAlgorithm(PriorityAlgorithm):
+    """Product of a list of metric names"""
+    factors = []
+    
+    # all metrics are non-negative
+    monotonic = True
+    
+    def metrics_used(self):
+        return list(self.factors)
+    
+    def combine(self, metrics):
+        return reduce(operator.mul, (getattr(metrics, name) for name in self.factors), 1.0)
+    
+    def combine_batch(self, matrix):
+        return matrix[:, [METRIC_COLUMNS[name] for name in self.factors]].prod(axis=1)
+
+class SingleSolidAngle(LinearAlgorithm):
+    name = 'Solid Angle'
+    weights = {'solid_angle': 1.0}
+
+class SingleFuture2SolidAngle(LinearAlgorithm):
+    name = 'Solid Angle +2'
+    weights = {'future_2_solid_angle': 1.0}
+
+class SingleFuture5SolidAngle(LinearAlgorithm):
+    name = 'Solid Angle +5'
+    weights = {'future_5_solid_angle': 1.0}
+
+class SingleCameraAngle(LinearAlgorithm):
+    name = 'Camera Angle'
+    weights = {'camera_angle': 1.0}
+
+class SingleCameraAngleExp(LinearAlgorithm):
+    name = 'Camera Angle Exp'
+    weights = {'camera_angle_exp': 1.0}
+
+class SingleFuture2CameraAngle(LinearAlgorithm):
+    name = 'Camera Angle +2'
+    weights = {'future_2_camera_angle': 1.0}
+
+class SingleFuture5CameraAngle(LinearAlgorithm):
+    name = 'Camera Angle +5'
+    weights = {'future_5_camera_angle': 1.0}
+
+class SingleDistance(LinearAlgorithm):
+    name = 'Distance'
+    weights = {'distance': 1.0}
+
+class SingleScale(LinearAlgorithm):
+    name = 'Scale'
+    weights = {'scale': 1.0}
+
+class SinglePerceptualError(LinearAlgorithm):
+    name = 'Perceptual Err'
+    weights = {'perceptual_error': 1.0}
+
+class SinglePerceptualErrorScale(LinearAlgorithm):
+    name = 'Perceptual Err * Scale'
+    weights = {'perceptual_error_scale': 1.0}
+
+class SinglePerceptualErrorSAng(LinearAlgorithm):
+    name = 'Perceptual Err * SAng'
+    weights = {'perceptual_error_sang': 1.0}
+
+class SinglePerceptualErrorExp(LinearAlgorithm):
+    name = 'Perceptual Err Exp'
+    weights = {'perceptual_error_exp': 1.0}
+
+class SinglePerceptualErrorExpScale(LinearAlgorithm):
+    name = 'Perceptual Err Exp * Scale'
+    weights = {'perceptual_error_exp_scale': 1.0}
+
+class SinglePerceptualErrorExpSAng(LinearAlgorithm):
+    name = 'Perceptual Err Exp * SAng'
+    weights = {'perceptual_error_exp_sang': 1.0}
+
+class Random(PriorityAlgorithm):
+    name = 'Random'
+    
+    def combine(self, metrics):
+        # note: not actually used because of optimization below using random.sample
+        raise NotImplementedError()
+
+class HandTuned1(LinearAlgorithm):
+    name = 'Hand Tuned Linear'
+    weights = {'solid_angle': 2000,
+               'camera_angle_exp': 50,
+               'scale': 50,
+               'distance': 50}
+
+class HandTuned2(ProductAlgorithm):
+    name = 'Multiply'
+    factors = ['solid_angle', 'camera_angle_exp', 'scale', 'distance']
+
+class OptimizationResult(LinearAlgorithm):
+    name = 'OptimizationResult'
+    weights = {'solid_angle': 1.00,
+               'distance': 0,
+               'scale': 0,
+               'camera_angle_exp': 0}
+
+class FromFile(LinearAlgorithm):
+    def __init__(self, fbuf):
+        self.w = json.load(fbuf)
+        assert isinstance(self.w['solid_angle'], float)
+        assert isinstance(self.w['future_2_solid_angle'], float)
+        assert isinstance(self.w['future_5_solid_angle'], float)
+        assert isinstance(self.w['camera_angle'], float)
+        assert isinstance(self.w['camera_angle_exp'], float)
+        assert isinstance(self.w['future_2_camera_angle'], float)
+        assert isinstance(self.w['future_5_camera_angle'], float)
+        assert isinstance(self.w['perceptual_error'], float)
+        assert isinstance(self.w['scale'], float)
+        assert isinstance(self.w['distance'], float)
+        assert isinstance(self.w['perceptual_error_scale'], float)
+        assert isinstance(self.w['perceptual_error_sang'], float)
+        
+        ignored = sorted(name for name, weight in self.w.iteritems() if name not in METRIC_COLUMNS and weight != 0)
+        if len(ignored) > 0:
+            print 'Ignoring weights of %s, which are not metrics of the prediction horizons' % ', '.join(ignored)
+    
+    # follows the prediction horizons, so weights of horizons that aren't predicted are left out
+    weights = property(lambda s: dict((name, weight) for name, weight in s.w.iteritems() if name in METRIC_COLUMNS))
+
+PRIORITY_ALGORITHMS = [Random,
+                       SingleSolidAngle, SingleCameraAngle, SinglePerceptualError,
+                       SingleCameraAngleExp,
+                       SinglePerceptualErrorScale, SinglePerceptualErrorSAng,
+                       SinglePerceptualErrorExp,SinglePerceptualErrorExpScale,SinglePerceptualErrorExpSAng,
+                       SingleFuture2SolidAngle, SingleFuture2CameraAngle,
+                       SingleFuture5SolidAngle, SingleFuture5CameraAngle,
+                       SingleDistance, SingleScale,
+                       FromFile,
+                       OptimizationResult,
+                       HandTuned1, HandTuned2]
+
+PRIORITY_ALGORITHM_NAMES = dict((a.__name__, a) for a in PRIORITY_ALGORITHMS)
+
+SELECTED_ALGORITHM = HandTuned1()
+
+def set_priority_algorithm(algorithm):
+    """Selects the algorithm tasks are prioritized with. Raises ValueError if
+    it uses a metric of a horizon that isn't predicted."""
+    global SELECTED_ALGORITHM
+    _check_metrics(algorithm, METRIC_NAMES, HORIZONS)
+    SELECTED_ALGORITHM = algorithm
+
+# cached metrics are reused until the camera moves or turns further than this
+CAMERA_MOVE_TOLERANCE = 0.0
+CAMERA_TURN_TOLERANCE = 0.0
+
+def set_camera_tolerance(move, turn):
+    """Sets how far (in scene units) the camera can move and turn (in degrees)
+    before cached metrics are recomputed"""
+    global CAMERA_MOVE_TOLERANCE, CAMERA_TURN_TOLERANCE
+    CAMERA_MOVE_TOLERANCE = move
+    CAMERA_TURN_TOLERANCE = turn
+
+def _max_forward_change():
+    """Distance between unit forward vectors CAMERA_TURN_TOLERANCE degrees apart"""
+    return 2.0 * math.sin(math.radians(CAMERA_TURN_TOLERANCE) / 2.0)
+
+def get_priority_algorithm_names():
+    return PRIORITY_ALGORITHM_NAMES.keys()
+
+def get_algorithm_by_name(name):
+    return PRIORITY_ALGORITHM_NAMES[name]
+
+class Metrics(object):
+    def __init__(self):
+        self.solid_angle = 0
+        self.future_2_solid_angle = 0
+        self.future_5_solid_angle = 0
+        self.camera_angle = 0
+        self.camera_angle_exp = 0
+        self.future_2_camera_angle = 0
+        self.future_5_camera_angle = 0
+        self.perceptual_error = 0
+        self.perceptual_error_scale = 0
+        self.perceptual_error_sang = 0
+        self.perceptual_error_exp = 0
+        self.perceptual_error_exp_scale = 0
+        self.perceptual_error_exp_sang = 0
+        self.distance = 0
+        self.scale = 0
+    
+    def combine(self):
+        return SELECTED_ALGORITHM.combine(self)
+
+def to_array(vec):
+    """Converts a Panda3D vector or point to a numpy array"""
+    return numpy.array(list(vec), dtype=numpy.float64)
+
+def center_distances(camera_pos, centers):
+    """Distance from camera_pos to each row of centers"""
+    to_center = centers - camera_pos
+    return numpy.sqrt(numpy.einsum('ij,ij->i', to_center, to_center))
+
+def calc_solid_angle(camera_pos, centers, radii):
+    """Solid angle of each bounding sphere seen from camera_pos, as a fraction of
+    the full sphere. Returns 1.0 for spheres that contain the camera."""
+    to_center_len = center_distances(camera_pos, centers)
+    inside = to_center_len <= radii
+    
+    # spheres containing the camera are masked out below, so use a safe
+    # divisor for them to avoid taking the root of a negative number
+    sin_alpha = radii / numpy.where(inside, radii, to_center_len)
+    cos_alpha = numpy.sqrt(1.0 - sin_alpha * sin_alpha)
+    solid_angle = 2.0 * math.pi * (1.0 - cos_alpha)
+    
+    return numpy.where(inside, 1.0, solid_angle / MAX_SOLID_ANGLE)
+
+def calc_distance(camera_pos, centers, radii):
+    """Inverse distance from camera_pos to the closest point of each bounding
+    sphere, clamped so that anything closer than 1.0 (or containing the
+    camera) is 1.0"""
+    to_surface = center_distances(camera_pos, centers) - radii
+    return 1.0 / numpy.maximum(to_surface, 1.0)
+
+def angle_deg(a, b):
+    """Angle in degrees between each row of unit vectors a and unit vector b.
+    Uses the same numerically stable formula as Panda3D's LVector3.angleDeg."""
+    dot = numpy.dot(a, b)
+    opposite = dot < 0
+    half_chord = numpy.where(opposite,
+                             numpy.sqrt(((a + b) ** 2).sum(axis=1)),
+                             numpy.sqrt(((a - b) ** 2).sum(axis=1))) / 2.0
+    angle = 2.0 * numpy.arcsin(numpy.minimum(half_chord, 1.0))
+    angle = numpy.where(opposite, math.pi - angle, angle)
+    return numpy.degrees(angle)
+
+def calc_camera_angle(camera_pos, camera_forward, centers, radii):
+    """How close each bounding sphere is to the center of view, from 1.0 when
+    the camera looks straight at the closest point of the sphere (or is inside
+    it) down to 0.0 when it is directly behind the camera"""
+    to_center = camera_pos - centers
+    to_center_len = numpy.sqrt(numpy.einsum('ij,ij->i', to_center, to_center))
+    inside = to_center_len <= radii
+    
+    # closest point on each sphere to the camera, then the direction the
+    # camera would have to face to look at it
+    safe_len = numpy.where(inside, 1.0, to_center_len)[:, numpy.newaxis]
+    closest_point = centers + to_center / safe_len * radii[:, numpy.newaxis]
+    to_closest = closest_point - camera_pos
+    to_closest_len = numpy.sqrt(numpy.einsum('ij,ij->i', to_closest, to_closest))
+    to_closest /= numpy.where(inside, 1.0, to_closest_len)[:, numpy.newaxis]
+    
+    angle_change = angle_deg(to_closest, camera_forward)
+    return numpy.where(inside, 1.0, 1.0 - (angle_change / 180.0))
+
+CameraPose = prediction.CameraPose
+
+def get_camera_poses(pandastate):
+    """Returns the current CameraPose followed by one for each of HORIZONS"""
+    curtime = pandastate.globalClock.getFrameTime()
+    return prediction.predict_camera_poses(pandastate.camera, pandastate.camera_smoother, curtime, HORIZONS)
+
+def combine_metrics(scale, solid_angles, camera_angles, distance, perceptual_error):
+    """Combines per-object metrics with the selected algorithm, returning a vector
+    of priorities. solid_angles and camera_angles hold an array for the current
+    camera pose followed by one for each of HORIZONS."""
+    solid_angle = solid_angles[0]
+    camera_angle = camera_angles[0]
+    
+    # camera angle and perceptual error with an exponential falloff
+    camera_angle_exp = camera_angle ** 20.0
+    perceptual_error_exp = perceptual_error ** 20.0
+    
+    columns = {'solid_angle': solid_angle,
+               'camera_angle': camera_angle,
+               'camera_angle_exp': camera_angle_exp,
+               'perceptual_error': perceptual_error,
+               'perceptual_error_scale': perceptual_error * scale,
+               'perceptual_error_sang': perceptual_error * solid_angle,
+               'perceptual_error_exp': perceptual_error_exp,
+               'perceptual_error_exp_scale': perceptual_error_exp * scale,
+               'perceptual_error_exp_sang': perceptual_error_exp * solid_angle,
+               'distance': distance,
+               'scale': scale}
+    
+    for horizon, future_solid_angle, future_camera_angle in zip(HORIZONS, solid_angles[1:], camera_angles[1:]):
+        future = prediction.horizon_name(horizon)
+        columns['%s_solid_angle' % future] = future_solid_angle
+        columns['%s_camera_angle' % future] = future_camera_angle
+    
+    matrix = numpy.column_stack([columns[name] for name in METRIC_NAMES]).reshape(len(scale), len(METRIC_NAMES))
+    return SELECTED_ALGORITHM.combine_batch(matrix)
+
+def calc_row_geometry(bounds, poses, rows):
+    """Metrics of the given rows of an InstanceBounds that depend on the camera,
+    as (solid angles, camera angles, distance) with a solid angle and camera
+    angle array for each pose"""
+    centers = bounds.centers[rows]
+    radii = bounds.radii[rows]
+    
+    solid_angles = [calc_solid_angle(pose.pos, centers, radii) for pose in poses]
+    camera_angles = [calc_camera_angle(pose.pos, pose.forward, centers, radii) for pose in poses]
+    distance = calc_distance(poses[0].pos, centers, radii)
+    
+    return solid_angles, camera_angles, distance
+
+class MetricsCache(object):
+    """Camera dependent metrics of each row of an InstanceBounds, along with the
+    camera poses they were computed at. A row is only recomputed once the camera
+    has moved or turned past the tolerance since then. Perceptual error is
+    combined in on every call, so changes to it take effect immediately."""
+    
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.valid = numpy.zeros(len(bounds), dtype=bool)
+        self.distance = numpy.zeros(len(bounds))
+        self.solid_angles = None
+        self.camera_angles = None
+        self.pose_pos = None
+        self.pose_forward = None
+    
+    def _reset(self, num_poses):
+        self.valid.fill(False)
+        self.solid_angles = numpy.zeros((num_poses, len(self.bounds)))
+        self.camera_angles = numpy.zeros((num_poses, len(self.bounds)))
+        self.pose_pos = numpy.zeros((num_poses, len(self.bounds), 3))
+        self.pose_forward = numpy.zeros((num_poses, len(self.bounds), 3))
+    
+    def get(self, poses, rows):
+        """Returns (solid angles, camera angles, distance) for the given rows,
+        recomputing any that are stale"""
+        if self.pose_pos is None or len(self.pose_pos) != len(poses):
+            self._reset(len(poses))
+        
+        stale = ~self.valid[rows]
+        max_turn = _max_forward_change()
+        for i, pose in enumerate(poses):
+            stale |= center_distances(pose.pos, self.pose_pos[i, rows]) > CAMERA_MOVE_TOLERANCE
+            stale |= center_distances(pose.forward, self.pose_forward[i, rows]) > max_turn
+        
+        stale_rows = numpy.unique(rows[stale])
+        if len(stale_rows) > 0:
+            solid_angles, camera_angles, distance = calc_row_geometry(self.bounds, poses, stale_rows)
+            self.distance[stale_rows] = distance
+            self.valid[stale_rows] = True
+            for i, pose in enumerate(poses):
+                self.solid_angles[i, stale_rows] = solid_angles[i]
+                self.camera_angles[i, stale_rows] = camera_angles[i]
+                self.pose_pos[i, stale_rows] = pose.pos
+                self.pose_forward[i, stale_rows] = pose.forward
+        
+        return list(self.solid_angles[:, rows]), list(self.camera_angles[:, rows]), self.distance[rows]
+
+def poses_moved(old_poses, poses):
+    """Returns True if the camera at any of poses has moved or turned further
+    than the metrics cache allows since old_poses"""
+    if len(old_poses) != len(poses):
+        return True
+    max_turn = _max_forward_change()
+    for old, pose in zip(old_poses, poses):
+        if numpy.linalg.norm(pose.pos - old.pos) > CAMERA_MOVE_TOLERANCE or \
+                numpy.linalg.norm(pose.forward - old.forward) > max_turn:
+            return True
+    return False
+
+def get_metrics_cache(pandastate):
+    if pandastate.metrics_cache is None:
+        pandastate.metrics_cache = MetricsCache(pandastate.instance_bounds)
+    return pandastate.metrics_cache
+
+def calc_row_priorities(pandastate, poses, rows, perceptual_error, cache=None):
+    """Combined priority of each of the given rows of the instance bounds. cache
+    defaults to the MetricsCache of pandastate."""
+    bounds = pandastate.instance_bounds
+    if cache is None:
+        cache = get_metrics_cache(pandastate)
+    solid_angles, camera_angles, distance = cache.get(poses, rows)
+    scale = bounds.radii[rows] / bounds.max_radius
+    return combine_metrics(scale, solid_angles, camera_angles, distance, perceptual_error)
+
+def calc_cell_upper_bounds(grid, max_radius, poses):
+    """Upper bound of the combined priority of any single object in each cell of
+    a SpatialGrid. Only valid for monotonic algorithms."""
+    lo, hi, radii = grid.cell_lo, grid.cell_hi, grid.cell_max_radius
+    
+    # every sphere in a cell lies inside the cell's bounding sphere
+    cell_centers = (lo + hi) / 2.0
+    cell_radii = numpy.sqrt(((hi - lo) ** 2).sum(axis=1)) / 2.0 + radii
+    
+    solid_angles = []
+    camera_angles = []
+    for pose in poses:
+        # a sphere of the cell's largest radius at the closest point of the cell box
+        closest = numpy.clip(pose.pos, lo, hi)
+        solid_angles.append(calc_solid_angle(pose.pos, closest, radii))
+        
+        # the direction to any point of the cell is within the cone around
+        # the cell's bounding sphere
+        to_center_len = center_distances(pose.pos, cell_centers)
+        inside = to_center_len <= cell_radii
+        safe_len = numpy.where(inside, 1.0, to_center_len)
+        to_center = (cell_centers - pose.pos) / safe_len[:, numpy.newaxis]
+        cone = numpy.degrees(numpy.arcsin(numpy.minimum(cell_radii / safe_len, 1.0)))
+        min_angle = numpy.maximum(angle_deg(to_center, pose.forward) - cone, 0.0)
+        camera_angles.append(numpy.where(inside, 1.0, 1.0 - (min_angle / 180.0)))
+    
+    closest = numpy.clip(poses[0].pos, lo, hi)
+    distance = calc_distance(poses[0].pos, closest, radii)
+    
+    return combine_metrics(radii / max_radius, solid_angles, camera_angles, distance, numpy.ones(len(grid)))
+
+def calc_visible_rows(pandastate, poses):
+    """Returns a boolean array of the rows of the instance bounds in view of
+    the camera at any of the given poses. The view is taken to be the cone
+    around the forward vector that encloses the lens' field of view."""
+    bounds = pandastate.instance_bounds
+    
+    fov = pandastate.camera.node().getLens().getFov()
+    half_diagonal = math.degrees(math.atan(math.hypot(math.tan(math.radians(fov[0] / 2.0)),
+                                                      math.tan(math.radians(fov[1] / 2.0)))))
+    min_camera_angle = 1.0 - half_diagonal / 180.0
+    
+    visible = numpy.zeros(len(bounds), dtype=bool)
+    for pose in poses:
+        visible |= calc_camera_angle(pose.pos, pose.forward, bounds.centers, bounds.radii) >= min_camera_angle
+    return visible
+
+def calc_visible_slugs(pandastate, poses=None):
+    """Returns the set of slugs with an instance in view of the camera at any
+    of the given poses, which default to get_camera_poses"""
+    if poses is None:
+        poses = get_camera_poses(pandastate)
+    bounds = pandastate.instance_bounds
+    
+    visible = calc_visible_rows(pandastate, poses)
+    visible_codes = set(numpy.unique(bounds.row_slug_codes[visible]))
+    return set(slug for slug, code in bounds.slug_codes.iteritems() if code in visible_codes)
+
+def _perceptual_error_metric(perceptual_error):
+    """Perceptual error in pixels as a metric, 1 for none and 0 for the whole screen"""
+    return 1.0 - (perceptual_error / (1024 * 768))
+
+def _queued_rows(pandastate, tasks):
+    """Returns (task list, rows of the instance bounds of each task one after the
+    other, index into the task list of each row, perceptual error metric of
+    each row). Only the rows of slugs with queued tasks are touched."""
+    bounds = pandastate.instance_bounds
+    task_list = [t for t in tasks if t.modelslug in bounds.slug_codes]
+    codes = numpy.array([bounds.slug_codes[t.modelslug] for t in task_list], dtype=numpy.intp)
+    rows, row_task = bounds.rows_for_slugs(codes)
+    
+    task_perceptual_error = numpy.array([t.perceptual_error for t in task_list], dtype=numpy.float64)
+    task_perceptual_error = _perceptual_error_metric(task_perceptual_error)
+    
+    return task_list, rows, row_task, task_perceptual_error[row_task]
+
+def _task_divisor(task):
+    """Download and pipeline tasks are prioritized per byte, everything else as is"""
+    if isinstance(task, (taskbase.DownloadTask, taskbase.PipelineTask)):
+        return float(task.download_size)
+    return 1.0
+
+def _task_divisors(task_list):
+    return numpy.array([_task_divisor(t) for t in task_list])
+
+class TaskTable(object):
+    """The slug code, perceptual error metric and divisor of each task in a
+    queue, kept in arrays as tasks are added and removed, so the best tasks
+    can be found without walking the queue in Python. Tasks of slugs that
+    aren't in the instance bounds are left out. Tasks of held types stay in
+    the table and are skipped by calc_table_highest_N."""
+    
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.tasks = []
+        """Task in each slot, the arrays below are indexed by slot"""
+        self.slots = {}
+        """A dict mapping each task to its slot"""
+        self.codes = numpy.zeros(16, dtype=numpy.intp)
+        self.perceptual_error = numpy.zeros(16)
+        self.divisors = numpy.ones(16)
+        self.held = numpy.zeros(16, dtype=bool)
+        self.held_types = ()
+    
+    def __len__(self):
+        return len(self.tasks)
+    
+    def __contains__(self, task):
+        return task in self.slots
+    
+    def _arrays(self):
+        return [self.codes, self.perceptual_error, self.divisors, self.held]
+    
+    def add(self, task):
+        """Adds task to the table, if it isn't already in it"""
+        if task in self.slots or task.modelslug not in self.bounds.slug_codes:
+            return
+        
+        slot = len(self.tasks)
+        if slot == len(self.codes):
+            self.codes, self.perceptual_error, self.divisors, self.held = \
+                [numpy.resize(array, 2 * slot) for array in self._arrays()]
+        
+        self.tasks.append(task)
+        self.slots[task] = slot
+        self.codes[slot] = self.bounds.slug_codes[task.modelslug]
+        self.divisors[slot] = _task_divisor(task)
+        self.held[slot] = isinstance(task, self.held_types)
+        self.update(task)
+    
+    def update(self, task):
+        """Reads the perceptual error of task again, for when it changed"""
+        slot = self.slots.get(task)
+        if slot is not None:
+            self.perceptual_error[slot] = _perceptual_error_metric(task.perceptual_error)
+    
+    def remove(self, task):
+        """Removes task from the table, if it's in it, by moving the last slot into its place"""
+        slot = self.slots.pop(task, None)
+        if slot is None:
+            return
+        
+        last = self.tasks.pop()
+        if slot < len(self.tasks):
+            self.tasks[slot] = last
+            self.slots[last] = slot
+            for array in self._arrays():
+                array[slot] = array[len(self.tasks)]
+    
+    def set_held(self, held_types):
+        """Flags the tasks that are instances of any of held_types"""
+        self.held_types = held_types
+        self.held[:len(self.tasks)] = [isinstance(task, held_types) for task in self.tasks]
+
+def calc_priority(pandastate, tasks, poses=None, cache=None):
+    """Returns a dict mapping each task to its priority. poses defaults to the
+    current camera poses, see get_camera_poses, and cache to the MetricsCache
+    of pandastate."""
+    task_list, rows, row_task, perceptual_error = _queued_rows(pandastate, tasks)
+    if poses is None:
+        poses = get_camera_poses(pandastate)
+    
+    row_priorities = calc_row_priorities(pandastate, poses, rows, perceptual_error, cache)
+    priorities = numpy.bincount(row_task, row_priorities, minlength=len(task_list)) / _task_divisors(task_list)
+    
+    return dict(zip(task_list, priorities))
+
+def calc_apply_priority(pandastate, tasks, poses=None):
+    """Returns a dict mapping each task to the priority of applying its result
+    to the scene. Unlike calc_priority it isn't per byte, since the bytes have
+    already been downloaded. poses defaults to the current camera poses."""
+    if isinstance(SELECTED_ALGORITHM, Random):
+        return dict((t, random.random()) for t in tasks)
+    
+    task_list, rows, row_task, perceptual_error = _queued_rows(pandastate, tasks)
+    if poses is None:
+        poses = get_camera_poses(pandastate)
+    row_priorities = calc_row_priorities(pandastate, poses, rows, perceptual_error)
+    priorities = numpy.bincount(row_task, row_priorities, minlength=len(task_list))
+    
+    return dict(zip(task_list, priorities))
+
+def _highest_N_bounded(pandastate, codes, perceptual_error, divisors, N, poses):
+    """Finds the N highest priority of the tasks given as arrays of their slug
+    codes, perceptual error metrics and divisors, without computing the
+    priority of every task. Returns (priority, index) pairs from highest to
+    lowest. Each task gets an upper bound from the grid cells its instances
+    fall in, then tasks are evaluated in order of decreasing upper bound until
+    no remaining task can beat the current Nth best."""
+    bounds = pandastate.instance_bounds
+    grid = pandastate.instance_grid
+    rows, row_task = bounds.rows_for_slugs(codes)
+    perceptual_error = perceptual_error[row_task]
+    
+    cell_bounds = calc_cell_upper_bounds(grid, bounds.max_radius, poses)
+    row_bounds = cell_bounds[grid.row_cell[rows]]
+    task_bounds = numpy.bincount(row_task, row_bounds, minlength=len(codes)) / divisors
+    order = numpy.argsort(-task_bounds)
+    
+    # min-heap of the best N (priority, task index) found so far
+    best = []
+    # batches double in size, so a loose bound costs a few calls rather than one per N tasks
+    start, batch_size = 0, N
+    while start < len(order):
+        if len(best) == N and task_bounds[order[start]] <= best[0][0]:
+            break
+        
+        batch = order[start:start + batch_size]
+        start, batch_size = start + batch_size, batch_size * 2
+        batch_rows = numpy.in1d(row_task, batch)
+        row_priorities = calc_row_priorities(pandastate, poses, rows[batch_rows], perceptual_error[batch_rows])
+        priorities = numpy.bincount(row_task[batch_rows], row_priorities, minlength=len(codes))
+        
+        for i in batch:
+            item = (priorities[i] / divisors[i], i)
+            if len(best) < N:
+                heapq.heappush(best, item)
+            elif item > best[0]:
+                heapq.heapreplace(best, item)
+    
+    return sorted(best, reverse=True)
+
+def calc_highest_N_bounded(pandastate, tasks, N, poses=None):
+    """Finds the N highest priority tasks without computing the priority of
+    every task, returning (task, priority) pairs from highest to lowest. See
+    _highest_N_bounded."""
+    bounds = pandastate.instance_bounds
+    task_list = [t for t in tasks if t.modelslug in bounds.slug_codes]
+    codes = numpy.array([bounds.slug_codes[t.modelslug] for t in task_list], dtype=numpy.intp)
+    perceptual_error = numpy.array([t.perceptual_error for t in task_list], dtype=numpy.float64)
+    if poses is None:
+        poses = get_camera_poses(pandastate)
+    
+    best = _highest_N_bounded(pandastate, codes, _perceptual_error_metric(perceptual_error),
+                              _task_divisors(task_list), N, poses)
+    return [(task_list[i], priority) for priority, i in best]
+
+def calc_table_highest_N(pandastate, table, N, poses=None):
+    """Returns the N highest priority tasks of a TaskTable that aren't held, as
+    (task, priority) pairs from highest to lowest. Apart from the tasks
+    picked, only array operations are done per queued task."""
+    if poses is None:
+        poses = get_camera_poses(pandastate)
+    slots = numpy.flatnonzero(~table.held[:len(table)])
+    
+    if isinstance(SELECTED_ALGORITHM, Random):
+        return [(table.tasks[i], random.random()) for i in random.sample(slots.tolist(), min(N, len(slots)))]
+    
+    codes = table.codes[slots]
+    perceptual_error = table.perceptual_error[slots]
+    divisors = table.divisors[slots]
+    
+    if SELECTED_ALGORITHM.monotonic:
+        best = _highest_N_bounded(pandastate, codes, perceptual_error, divisors, N, poses)
+    else:
+        rows, row_task = pandastate.instance_bounds.rows_for_slugs(codes)
+        row_priorities = calc_row_priorities(pandastate, poses, rows, perceptual_error[row_task])
+        priorities = numpy.bincount(row_task, row_priorities, minlength=len(codes)) / divisors
+        best = [(priorities[i], i) for i in numpy.argsort(-priorities)[:N]]
+    
+    return [(table.tasks[slots[i]], priority) for priority, i in best]
+
+def update_priorities(pandastate, queue, tasks, poses=None):
+    """Rescores the given tasks of a katasked.task.pool.IndexedHeap, touching
+    only the ones whose priority changed"""
+    if isinstance(SELECTED_ALGORITHM, Random):
+        for task in tasks:
+            queue.update(task, random.random())
+        return
+    
+    for task, priority in calc_priority(pandastate, tasks, poses).iteritems():
+        if priority != queue.get_priority(task):
+            queue.update(task, priority)
+
+def rank_priorities(pandastate, tasks, poses=None, cache=None):
+    """Returns (task, priority) pairs sorted from highest to lowest priority"""
+    if isinstance(SELECTED_ALGORITHM, Random):
+        task_priorities = dict((t, random.random()) for t in tasks)
+    else:
+        task_priorities = calc_priority(pandastate, tasks, poses, cache)
+    return sorted(task_priorities.iteritems(), key=operator.itemgetter(1), reverse=True)
+
+def rank_tasks(pandastate, tasks, poses=None, cache=None):
+    """Returns tasks sorted from highest to lowest priority"""
+    return [task for task, priority in rank_priorities(pandastate, tasks, poses, cache)]
+
+def calc_highest_N(pandastate, tasks, N, poses=None):
+    """Returns the N highest priority tasks as (task, priority) pairs from
+    highest to lowest"""
+    # optimization - don't bother calculating priority if it's random
+    if isinstance(SELECTED_ALGORITHM, Random):
+        return [(t, random.random()) for t in random.sample(tasks, min(N, len(tasks)))]
+    
+    if SELECTED_ALGORITHM.monotonic:
+        return calc_highest_N_bounded(pandastate, tasks, N, poses)
+    
+    task_priorities = calc_priority(pandastate, tasks, poses)
+    return heapq.nlargest(N, task_priorities.iteritems(), key=operator.itemgetter(1))
+
+def get_highest_N(pandastate, tasks, N):
+    return [task for task, priority in calc_highest_N(pandastate, tasks, N)]
@@ -1,4 +1,4 @@
 from collections import namedtuple
 
-TaskResult = namedtuple('TaskResult', ['task', 'result'])
-"""A task and its result"""
+TaskResult = namedtuple('TaskResult', ['task', 'result', 'started'])
+"""A task, its result and the time it was started"""
@@ -0,0 +1,62 @@
+import threading
+import traceback
+
+import katasked.task.priority as priority
+
+class BackgroundScheduler(object):
+    """Computes task priorities on a background thread so that the cost of
+    prioritizing doesn't land on the render thread. The main thread submits a
+    snapshot of the camera poses and of the queued tasks of each pool, and the
+    thread publishes the queued tasks ranked from highest to lowest priority,
+    along with their priorities. The thread keeps a MetricsCache of its own,
+    since the one in the PandaState belongs to the main thread."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.snapshot = None
+        self.rankings = {}
+        self.metrics_cache = None
+        """MetricsCache only used by the thread"""
+        
+        self.thread = threading.Thread(target=self._run, name='BackgroundScheduler')
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def submit(self, pandastate, poses, queues):
+        """Replaces the pending snapshot. poses is the result of
+        priority.get_camera_poses and queues maps a pool name to a list of its
+        queued tasks."""
+        with self.lock:
+            self.snapshot = (pandastate, poses, queues)
+        self.wakeup.set()
+    
+    def get_ranking(self, name):
+        """Returns the latest ranking for the given pool name as (task, priority)
+        pairs from highest to lowest, or None if one hasn't been computed yet"""
+        with self.lock:
+            return self.rankings.get(name)
+    
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            
+            with self.lock:
+                snapshot, self.snapshot = self.snapshot, None
+            if snapshot is None:
+                continue
+            
+            pandastate, poses, queues = snapshot
+            if self.metrics_cache is None or self.metrics_cache.bounds is not pandastate.instance_bounds:
+                self.metrics_cache = priority.MetricsCache(pandastate.instance_bounds)
+            
+            rankings = {}
+            for name, tasks in queues.iteritems():
+                try:
+                    rankings[name] = priority.rank_priorities(pandastate, tasks, poses, self.metrics_cache)
+                except Exception:
+                    traceback.print_exc()
+            
+            with self.lock:
+                self.rankings.update(rankings)
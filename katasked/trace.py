@@ -0,0 +1,107 @@
+import json
+import time
+import itertools
+import collections
+
+ENQUEUE = 'enqueue'
+DISPATCH = 'dispatch'
+COMPLETE = 'complete'
+APPLY = 'apply'
+CANCEL = 'cancel'
+
+TraceEvent = collections.namedtuple('TraceEvent', ['time', 'kind', 'trace_id', 'task_name', 'modelslug', 'pool_name',
+                                                   'size', 'priority', 'running'])
+"""What happened to a task and when. priority is only known at dispatch and
+running, the number of requests a pool has in flight, at dispatch and
+completion."""
+
+DEFAULT_CAPACITY = 1000000
+
+MAIN_THREAD = 'main thread'
+"""pool_name of apply events"""
+
+# each task goes through these spans, named by the event that ends them
+_SPANS = {DISPATCH: (ENQUEUE, 'queued'),
+          COMPLETE: (DISPATCH, 'running'),
+          APPLY: (COMPLETE, 'waiting to apply')}
+
+_tracer = None
+
+def _args(event):
+    args = {'task': event.task_name, 'slug': event.modelslug}
+    if event.size is not None:
+        args['bytes'] = event.size
+    if event.priority is not None:
+        args['priority'] = event.priority
+    return args
+
+class Tracer(object):
+    """Keeps the last capacity scheduler events in a ring buffer"""
+    
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.events = collections.deque(maxlen=capacity)
+        self.start_time = time.time()
+        self.trace_ids = itertools.count()
+    
+    def record(self, kind, task, pool_name, task_priority=None, running=None):
+        trace_id = getattr(task, 'trace_id', None)
+        if trace_id is None:
+            trace_id = task.trace_id = next(self.trace_ids)
+        self.events.append(TraceEvent(time.time(), kind, trace_id, type(task).__name__, task.modelslug, pool_name,
+                                      getattr(task, 'download_size', None), task_priority, running))
+    
+    def chrome_trace(self):
+        """Returns the events in the Chrome trace event format, which
+        chrome://tracing and Perfetto can open. Each pool is a process, every
+        task has a queued, running and waiting to apply span, and the requests
+        each pool has in flight are a counter."""
+        pids = {}
+        trace_events = []
+        begins = {}
+        
+        def pid(pool_name):
+            if pool_name not in pids:
+                pids[pool_name] = len(pids) + 1
+                trace_events.append({'ph': 'M', 'name': 'process_name', 'pid': pids[pool_name], 'tid': 0,
+                                     'args': {'name': pool_name}})
+            return pids[pool_name]
+        
+        for event in self.events:
+            ts = (event.time - self.start_time) * 1e6
+            if event.kind in _SPANS:
+                begin_kind, span_name = _SPANS[event.kind]
+                begin = begins.pop((event.trace_id, begin_kind), None)
+                # the begin may have fallen off the ring buffer
+                if begin is not None:
+                    span = {'cat': begin.pool_name, 'name': span_name, 'id': event.trace_id, 'tid': 0,
+                            'pid': pid(begin.pool_name)}
+                    trace_events.append(dict(span, ph='b', ts=(begin.time - self.start_time) * 1e6,
+                                             args=_args(begin)))
+                    trace_events.append(dict(span, ph='e', ts=ts))
+            begins[(event.trace_id, event.kind)] = event
+            
+            trace_events.append({'ph': 'i', 's': 't', 'name': '%s %s' % (event.kind, event.task_name),
+                                 'pid': pid(event.pool_name), 'tid': 0, 'ts': ts, 'args': _args(event)})
+            if event.running is not None:
+                trace_events.append({'ph': 'C', 'name': 'in flight', 'pid': pid(event.pool_name), 'tid': 0,
+                                     'ts': ts, 'args': {'requests': event.running}})
+        
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+def init_trace(capacity=DEFAULT_CAPACITY):
+    """Starts recording events, keeping the last capacity of them"""
+    global _tracer
+    _tracer = Tracer(capacity)
+
+def record(kind, task, pool_name, task_priority=None, running=None):
+    """Records an event of a task if tracing was started with init_trace"""
+    if _tracer is not None:
+        _tracer.record(kind, task, pool_name, task_priority, running)
+
+def write_trace(path):
+    """Writes the recorded events to path as Chrome trace JSON"""
+    if _tracer is None:
+        return
+    with open(path, 'w') as f:
+        json.dump(_tracer.chrome_trace(), f)
+    print 'Wrote %d trace events to %s' % (len(_tracer.events), path)